@@ -0,0 +1,215 @@
+'''Batched evaluation of one expression over many inputs with NumPy.
+
+eval_batch() binds every free variable of an expression to a column of
+values, one per row, and evaluates the expression for all rows at once.
+Trees made only of Lit, Name, Add, Sub, Mul, Div, Neg, Lt, Gt, Eq, And, Or,
+Not and If over integer and boolean columns run as array operations; any
+other expression runs row by row through interp_fun, as one eval() per row
+would.
+
+Either way every row gets the value or the error its own eval() gives: Div
+floors, as Python's // does; And, Or and If only evaluate an operand for the
+rows that reach it; and a row that divides by zero (or fails a type check)
+gets its own exception without affecting the others.  Rows whose arithmetic
+leaves the int64 range are rerun on the scalar path, where integers are
+unbounded.
+'''
+
+from collections.abc import Mapping, Sequence
+
+import numpy as np
+
+from interp_fun import EvalError, Expr, Store, compileExpr, emptyEnv, envNames, extendEnv, optimizeExpr, runCode
+from interp_fun import Add, Sub, Mul, Div, Neg, Name, Lit, And, Or, Not, Eq, Lt, Gt, If
+
+
+class BatchResult:
+    '''Results of eval_batch.  values[i] is the value of row i unless errors holds
+    the exception row i raised; scalar_rows counts the rows evaluated one by one.'''
+    __slots__ = ('values', 'errors', 'scalar_rows')
+
+    def __init__(self, values: np.ndarray, errors: dict[int, Exception], scalar_rows: int):
+        self.values = values
+        self.errors = errors
+        self.scalar_rows = scalar_rows
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def outcome(self, row: int):
+        '''The value of row, raising its exception instead if it has one'''
+        error = self.errors.get(row)
+        if error is not None:
+            raise error
+        return self.values[row].item() if isinstance(self.values[row], np.generic) else self.values[row]
+
+
+class _NotVectorizable(Exception):
+    '''The expression, or a column, cannot be evaluated as array operations'''
+
+
+_INT64 = np.iinfo(np.int64)
+_INT, _BOOL = 'int', 'bool'
+
+
+def _column(values) -> tuple[np.ndarray, str]:
+    '''A column as an int64 or bool array, with its kind'''
+    if isinstance(values, np.ndarray):
+        if values.dtype == np.bool_:
+            return values, _BOOL
+        if values.dtype.kind == 'i' or (values.dtype.kind == 'u' and (values.size == 0 or values.max() <= _INT64.max)):
+            return values.astype(np.int64, copy=False), _INT
+        raise _NotVectorizable(f'column of {values.dtype}')
+    types = set(map(type, values))
+    # NumPy would turn a mix of ints and bools into ints, but Eq tells them apart
+    if types == {bool}:
+        return np.array(values, dtype=np.bool_), _BOOL
+    if types <= {int}:
+        try:
+            return np.array(values, dtype=np.int64), _INT
+        except OverflowError:
+            raise _NotVectorizable('integers beyond int64')
+    raise _NotVectorizable(f'column of {", ".join(sorted(t.__name__ for t in types))}')
+
+
+class _Vectorizer:
+    '''Evaluates an expression for all rows of the columns at once.
+
+    expr() takes the mask of rows that evaluate e and returns an array of e's
+    values (meaningful only for those rows) and its kind.  A row that raises
+    leaves alive with its exception recorded in errors, and one that overflows
+    int64 leaves it for rerun; rows that have left are ignored from then on,
+    just as their scalar evaluation would have stopped.'''
+    def __init__(self, columns: dict[str, tuple[np.ndarray, str]], n: int):
+        self.columns = columns
+        self.alive = np.ones(n, dtype=np.bool_)
+        self.rerun = np.zeros(n, dtype=np.bool_)
+        self.errors: dict[int, Exception] = {}
+
+    def fail(self, active: np.ndarray, bad: np.ndarray, error_type: type, message: str) -> None:
+        bad = bad & active & self.alive
+        for row in np.flatnonzero(bad):
+            self.errors[int(row)] = error_type(message)
+        self.alive &= ~bad
+
+    def overflow(self, active: np.ndarray, bad: np.ndarray) -> None:
+        bad = bad & active & self.alive
+        self.rerun |= bad
+        self.alive &= ~bad
+
+    def integers(self, e: Expr, active: np.ndarray) -> np.ndarray:
+        # Arithmetic and comparisons take booleans as integers (isinstance(True, int) holds)
+        value, kind = self.expr(e, active)
+        return value.astype(np.int64) if kind == _BOOL else value
+
+    def booleans(self, e: Expr, active: np.ndarray, message: str) -> np.ndarray:
+        value, kind = self.expr(e, active)
+        if kind != _BOOL:
+            self.fail(active, np.True_, TypeError, message)
+            return np.zeros_like(active)
+        return value
+
+    def expr(self, e: Expr, active: np.ndarray) -> tuple[np.ndarray, str]:
+        match e:
+            case Lit(value) if type(value) is bool:
+                return np.full(active.shape, value), _BOOL
+            case Lit(value) if type(value) is int and _INT64.min <= value <= _INT64.max:
+                return np.full(active.shape, value, dtype=np.int64), _INT
+            case Name(name) if name in self.columns:
+                return self.columns[name]
+            case Add(left, right) | Sub(left, right):
+                l, r = self.integers(left, active), self.integers(right, active)
+                if isinstance(e, Add):
+                    result = l + r
+                    self.overflow(active, ((l ^ result) & (r ^ result)) < 0)
+                else:
+                    result = l - r
+                    self.overflow(active, ((l ^ r) & (l ^ result)) < 0)
+                return result, _INT
+            case Mul(left, right):
+                l, r = self.integers(left, active), self.integers(right, active)
+                # Conservative: rerun anything near the limit rather than risk a wrapped product
+                self.overflow(active, np.abs(l.astype(np.float64) * r) >= 2.0 ** 62)
+                return l * r, _INT
+            case Div(left, right):
+                l, r = self.integers(left, active), self.integers(right, active)
+                zero, wraps = r == 0, (l == _INT64.min) & (r == -1)
+                self.fail(active, zero, ZeroDivisionError, "Division by zero")
+                self.overflow(active, wraps)
+                # Divide the rows that left by 1 instead, so NumPy has nothing to warn about
+                return np.floor_divide(l, np.where(zero | wraps, 1, r)), _INT
+            case Neg(expr):
+                v = self.integers(expr, active)
+                self.overflow(active, v == _INT64.min)
+                return -v, _INT
+            case Lt(left, right) | Gt(left, right):
+                l, r = self.integers(left, active), self.integers(right, active)
+                return (l < r if isinstance(e, Lt) else l > r), _BOOL
+            case Eq(left, right):
+                (l, l_kind), (r, r_kind) = self.expr(left, active), self.expr(right, active)
+                if l_kind != r_kind:
+                    return np.zeros_like(active), _BOOL  # An int never equals a bool
+                return l == r, _BOOL
+            case And(left, right) | Or(left, right):
+                message = "And expects booleans" if isinstance(e, And) else "Or expects booleans"
+                l = self.booleans(left, active, message)
+                # And evaluates the right operand only where the left is true, Or where it is false
+                reach = active & (l if isinstance(e, And) else ~l)
+                r = self.booleans(right, reach, message)
+                return (l & r if isinstance(e, And) else l | r), _BOOL
+            case Not(expr):
+                return ~self.booleans(expr, active, "Not expects booleans"), _BOOL
+            case If(cond, then_branch, else_branch):
+                c = self.booleans(cond, active, "If condition must be a boolean")
+                (t, t_kind), (f, f_kind) = self.expr(then_branch, active & c), self.expr(else_branch, active & ~c)
+                if t_kind != f_kind:
+                    raise _NotVectorizable('If branches of different types')
+                return np.where(c, t, f), t_kind
+        raise _NotVectorizable(type(e).__name__)
+
+
+def _scalar_rows(e: Expr, names: list[str], columns: dict[str, Sequence], rows, values: np.ndarray,
+                 errors: dict[int, Exception]) -> None:
+    '''Evaluate e for each of rows with interp_fun, filling in values and errors'''
+    scope = tuple(reversed(names))  # The order extendEnv below leaves them in
+    try:
+        code = compileExpr(optimizeExpr(e, scope))
+    except EvalError as error:
+        for row in rows:
+            errors[row] = error
+        return
+    store = Store()
+    for row in rows:
+        env = emptyEnv
+        for name in names:
+            value = columns[name][row]
+            env = extendEnv(name, store.alloc(value.item() if isinstance(value, np.generic) else value), env)
+        try:
+            values[row] = runCode(code, env, store)
+        except Exception as error:
+            errors[row] = error
+
+
+def eval_batch(e: Expr, columns: Mapping[str, Sequence]) -> BatchResult:
+    '''Evaluate e once per row, with each name in columns bound to that row's
+    element of its column (all columns must have the same length).  Pure
+    arithmetic and boolean trees over int and bool columns run as NumPy array
+    operations; anything else falls back to evaluating row by row.'''
+    names = list(columns)
+    lengths = {len(columns[name]) for name in names}
+    if len(lengths) > 1:
+        raise ValueError(f"Columns have different lengths: {sorted(lengths)}")
+    n = lengths.pop() if lengths else 1
+    try:
+        vectorizer = _Vectorizer({name: _column(columns[name]) for name in names}, n)
+        value, _ = vectorizer.expr(e, np.ones(n, dtype=np.bool_))
+    except _NotVectorizable:
+        values = np.empty(n, dtype=object)
+        errors: dict[int, Exception] = {}
+        _scalar_rows(e, names, columns, range(n), values, errors)
+        return BatchResult(values, errors, n)
+    rerun = np.flatnonzero(vectorizer.rerun)
+    if len(rerun):
+        value = value.astype(object)  # Room for the unbounded integers of the rerun rows
+        _scalar_rows(e, names, columns, rerun.tolist(), value, vectorizer.errors)
+    return BatchResult(value, vectorizer.errors, len(rerun))
@@ -0,0 +1,630 @@
+'''Micro-benchmarks for the parser and interpreter.
+
+Run a single benchmark with `python bench.py <name>`, or all of them with no arguments.
+'''
+
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from statistics import median
+
+HERE = Path(__file__).parent
+
+
+# Child snippet: hide the generated parser so parse_run falls back to lark
+FORCE_DYNAMIC = "import sys; sys.modules['expr_fun_parser'] = None; "
+# Child snippet: report peak resident memory in KiB.  ru_maxrss is inherited
+# across fork/exec on Linux, so read the per-process high-water mark instead.
+REPORT_RSS = ("; print(next(l.split()[1] for l in open('/proc/self/status')"
+              " if l.startswith('VmHWM')))")
+# Startup numbers should reflect normal deployments, where bytecode is cached
+CHILD_ENV = {k: v for k, v in os.environ.items() if k != 'PYTHONDONTWRITEBYTECODE'}
+
+
+def _time_subprocess(code: str, runs: int) -> tuple[float, float]:
+    '''Median wall-clock time in milliseconds of running code in a fresh interpreter,
+    and the median of the last number it printed (used for peak RSS)'''
+    times, outputs = [], []
+    for _ in range(runs):
+        start = time.perf_counter()
+        proc = subprocess.run([sys.executable, '-c', code + REPORT_RSS], cwd=HERE, env=CHILD_ENV,
+                              check=True, capture_output=True, text=True)
+        times.append((time.perf_counter() - start) * 1000)
+        outputs.append(float(proc.stdout.split()[-1]))
+    return median(times), median(outputs)
+
+
+def bench_startup(runs: int = 10) -> None:
+    '''Import time and peak RSS of parse_run with each parser and cache state'''
+    from parse_run import GRAMMAR_CACHE, standalone
+
+    rows = [('interpreter only', _time_subprocess('pass', runs))]
+
+    cold = []
+    for _ in range(runs):
+        GRAMMAR_CACHE.unlink(missing_ok=True)
+        cold.append(_time_subprocess(FORCE_DYNAMIC + 'import parse_run', 1))
+    rows.append(('lark (cold cache)', (median(t for t, _ in cold), median(r for _, r in cold))))
+
+    # The last cold run left a fresh cache behind
+    rows.append(('lark (warm cache)', _time_subprocess(FORCE_DYNAMIC + 'import parse_run', runs)))
+
+    if standalone is not None:
+        _time_subprocess('import parse_run', 1)  # write expr_fun_parser's bytecode
+        rows.append(('standalone', _time_subprocess('import parse_run', runs)))
+    else:
+        print("startup: expr_fun_parser.py not built, skipping standalone (run build_parser.py)")
+
+    for label, (ms, rss) in rows:
+        print(f"startup: {label:<20} {ms:8.1f} ms  {rss / 1024:6.1f} MiB peak RSS")
+
+
+def generate_script(n: int) -> str:
+    '''A machine-generated looking script of n top-level statements'''
+    return '; '.join(
+        f"let x{i} = {i} in if x{i} < {n // 2} then x{i} := x{i} * 2 + 1 else (x{i} := x{i} - 1; x{i}) end"
+        for i in range(n)
+    )
+
+
+def _throughput(fn, arg, seconds: float = 1.0) -> float:
+    '''Calls per second of fn(arg), measured over roughly the given number of seconds'''
+    calls, start = 0, time.perf_counter()
+    while (elapsed := time.perf_counter() - start) < seconds:
+        fn(arg)
+        calls += 1
+    return calls / elapsed
+
+
+def _peak_memory(fn, arg) -> int:
+    '''Peak bytes allocated by Python while running fn(arg)'''
+    tracemalloc.start()
+    try:
+        fn(arg)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench_parse() -> None:
+    '''Parse+AST throughput and peak memory: parse tree then genAST, versus inline reduction'''
+    from parse_run import parse, genAST, parse_ast
+
+    modes = {
+        'tree+genAST': lambda s: genAST(parse(s)),
+        'inline': parse_ast,
+    }
+    for n in (100, 1000, 10000):
+        script = generate_script(n)
+        for label, fn in modes.items():
+            rate = _throughput(fn, script)
+            peak = _peak_memory(fn, script)
+            print(f"parse: {n:6} stmts  {label:<12} {rate:9.2f} scripts/s  {peak / 2**20:8.2f} MiB peak")
+
+
+def bench_backends() -> None:
+    '''Tokens per second of the Lark (inline AST) and hand-written parser backends'''
+    from descent_parser import tokenize
+    from parse_run import parse_ast
+
+    for n in (100, 1000):
+        script = generate_script(n)
+        tokens = len(tokenize(script)[0]) - 1
+        for backend in ('lark', 'descent'):
+            rate = _throughput(lambda s: parse_ast(s, backend=backend), script)
+            print(f"backends: {n:5} stmts  {backend:<8} {rate * tokens:12,.0f} tokens/s")
+
+
+def bench_intern() -> None:
+    '''Node count and AST memory of generated scripts with and without hash-consing'''
+    from interp_fun import Interner, astSize, distinctNodeCount, nodeCount
+    from parse_run import parse_ast
+
+    for n in (100, 1000):
+        ast = parse_ast(generate_script(n))
+        interner = Interner()
+        interned = interner.intern(ast)
+        assert interned == ast
+        print(f"intern: {n:5} stmts  {nodeCount(ast):7} nodes  "
+              f"{distinctNodeCount(ast):7} -> {distinctNodeCount(interned):7} distinct  "
+              f"{astSize(ast) / 2**20:6.2f} -> {astSize(interned) / 2**20:6.2f} MiB  "
+              f"({interner.hits} shared)")
+
+
+def bench_node_size() -> None:
+    '''Bytes per AST node by class, and total AST size of generated programs'''
+    import sys
+    from interp_fun import Add, Name, Lit, Let, If, Assign, Block, astSize, nodeCount
+    from parse_run import parse_ast
+
+    samples = [Lit(1), Name("x"), Add(Lit(1), Lit(2)), Assign("x", Lit(1)),
+               Let("x", Lit(1), Lit(2)), If(Lit(True), Lit(1), Lit(2)), Block([Lit(1), Lit(2)])]
+    for node in samples:
+        size = sys.getsizeof(node) + (sys.getsizeof(node.__dict__) if hasattr(node, '__dict__') else 0)
+        print(f"node_size: {type(node).__name__:<8} {size:4} bytes")
+    for n in (1000, 10000):
+        ast = parse_ast(generate_script(n))
+        total, count = astSize(ast), nodeCount(ast)
+        print(f"node_size: {n:6} stmts  {count:7} nodes  {total / 2**20:7.2f} MiB  {total / count:6.1f} bytes/node")
+
+
+LETFUN_PROGRAMS = {
+    'fib(18)': 'letfun fib(n) = if n < 2 then n else fib(n - 1) + fib(n - 2) in fib(18) end',
+    'countdown(150)': 'letfun loop(n) = if n == 0 then 0 else loop(n - 1) in loop(150) end',
+    'sum loop(150)': 'let s = 0 in letfun loop(n) = if n == 0 then s else (s := s + n; loop(n - 1)) '
+                     'in loop(150) end end',
+}
+
+
+def _time_calls(fn, runs: int = 5) -> float:
+    '''Best-of-runs wall-clock time of fn() in milliseconds'''
+    best = float('inf')
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def bench_eval() -> None:
+    '''Evaluation time of recursive letfun programs'''
+    from interp_fun import eval
+    from parse_run import parse_ast
+
+    for label, source in LETFUN_PROGRAMS.items():
+        ast = parse_ast(source)
+        print(f"eval: {label:<15} {_time_calls(lambda: eval(ast)):9.2f} ms")
+
+
+SERVICE_SCRIPTS = [
+    'let x = 3 in x * x + 1 end',
+    'let n = 10 in if n > 5 then n - 5 else n + 5 end',
+    'letfun fact(n) = if n < 1 then 1 else n * fact(n - 1) in fact(10) end',
+    'let s = "id-" in s + 42 end',
+    'let x = 0 in x := x + 1; x := x * 10; x end',
+]
+
+
+def bench_ast_cache(calls: int = 20000) -> None:
+    '''Per-call latency of parse+eval for a small set of repeated scripts, with and without the AST cache'''
+    from interp_fun import eval
+    from parse_run import ASTCache, parse_ast
+
+    cache = ASTCache()
+    modes = {
+        'uncached': parse_ast,
+        'cached': cache.parse,
+    }
+    for label, parse_fn in modes.items():
+        start = time.perf_counter()
+        for i in range(calls):
+            eval(parse_fn(SERVICE_SCRIPTS[i % len(SERVICE_SCRIPTS)]))
+        elapsed = time.perf_counter() - start
+        print(f"ast_cache: {label:<9} {elapsed / calls * 1e6:8.1f} us/call")
+    print(f"ast_cache: {cache.stats()}")
+
+
+def bench_stream() -> None:
+    '''Peak memory of running a generated script file whole versus one statement at a time'''
+    import tempfile
+    from interp_fun import eval
+    from parse_run import parse_ast, run_file
+
+    def whole(path):
+        with open(path) as f:
+            return eval(parse_ast(f.read()))
+
+    for n in (500, 5000):
+        with tempfile.NamedTemporaryFile('w', suffix='.fun', delete=False) as f:
+            f.write(generate_script(n))
+        path = Path(f.name)
+        try:
+            for label, fn in (('whole', whole), ('stream', run_file)):
+                start = time.perf_counter()
+                try:
+                    peak = _peak_memory(fn, path)
+                except RecursionError:
+                    print(f"stream: {n:6} stmts  {label:<7} RecursionError")
+                    continue
+                elapsed = time.perf_counter() - start
+                print(f"stream: {n:6} stmts  {label:<7} {elapsed:7.2f} s  {peak / 2**20:8.2f} MiB peak")
+        finally:
+            path.unlink()
+
+
+def bench_codegen(runs: int = 10) -> None:
+    '''Evaluation time of the Python source backend, and run time of a script with a cold and warm code cache'''
+    import codegen
+    from interp_fun import Store, emptyEnv, eval
+    from parse_run import parse_ast
+
+    for label, source in LETFUN_PROGRAMS.items():
+        ast = parse_ast(source)
+        code = codegen.compile_ast(ast)
+        print(f"codegen: {label:<15} closures {_time_calls(lambda: eval(ast)):8.2f} ms  "
+              f"python {_time_calls(lambda: code(emptyEnv, Store())):8.2f} ms")
+
+    script = generate_script(200)
+    run = f"import codegen; codegen.run_source({script!r})"
+    cold = []
+    for _ in range(runs):
+        codegen.CODE_CACHE_DIR.joinpath(f'{codegen.cache_key(script)}.bin').unlink(missing_ok=True)
+        cold.append(_time_subprocess(run, 1)[0])
+    print(f"codegen: 200 stmts script  cold cache {median(cold):8.1f} ms  "
+          f"warm cache {_time_subprocess(run, runs)[0]:8.1f} ms")
+
+
+def nested_lets(n: int) -> str:
+    '''n nested lets, each of which reads the outermost variable'''
+    return ''.join(f"let x{i} = x0 + {i} in " if i else "let x0 = 0 in " for i in range(n)) + "x0" + " end" * n
+
+
+def bench_resolve() -> None:
+    '''Evaluation time of deeply nested lets with lookup by name versus resolved (depth) addressing'''
+    from interp_fun import Store, compileExpr, emptyEnv, resolve
+    from parse_run import parse_ast
+
+    for n in (100, 300, 600):
+        ast = parse_ast(nested_lets(n))
+        for label, code in (('by name', compileExpr(ast)), ('resolved', compileExpr(resolve(ast)))):
+            print(f"resolve: {n:4} lets  {label:<8} {_time_calls(lambda: code(emptyEnv, Store())):8.2f} ms")
+
+
+def bench_env() -> None:
+    '''Cost of building, searching and evaluating in environments 10, 1k and 100k bindings deep'''
+    from interp_fun import Store, compileExpr, emptyEnv, envLoc, extendEnv, lookupEnv, resolve
+    from parse_run import parse_ast
+
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 20000))
+    for n in (10, 1000, 100000):
+        def build():
+            env = emptyEnv
+            for i in range(n):
+                env = extendEnv(f"x{i}", i, env)
+            return env
+        env = build()
+        print(f"env: {n:6} bindings  build {_time_calls(build):9.3f} ms  "
+              f"outermost by name {_time_calls(lambda: lookupEnv('x0', env)) * 1000:9.1f} us  "
+              f"by depth {_time_calls(lambda: envLoc(env, n - 1)) * 1000:9.1f} us")
+        if n > 1000:
+            continue  # Nesting 100k lets is beyond the recursive parser and compiler
+        source = ''.join(f"let x{i} = {i} in " for i in range(n)) + "x0" + " end" * n
+        code = compileExpr(resolve(parse_ast(source)))
+        print(f"env: {n:6} nested lets  eval {_time_calls(lambda: code(emptyEnv, Store())):9.3f} ms")
+
+
+def bench_gc() -> None:
+    '''Store size and run time of recursive programs with and without store collection'''
+    from interp_fun import Store, eval
+    from parse_run import parse_ast
+
+    fib = 'letfun fib(n) = if n < 2 then n else fib(n - 1) + fib(n - 2) in fib({}) end'
+    for n in (15, 20, 24):
+        ast = parse_ast(fib.format(n))
+        for label, threshold in (('off', None), ('on', 1024)):
+            store = Store(threshold)
+            ms = _time_calls(lambda: eval(ast, None, store), runs=1)
+            stats = store.stats()
+            print(f"gc: fib({n}) {label:<3} {ms:9.1f} ms  {stats['size']:8} cells  "
+                  f"{stats['collections']:5} collections  {_peak_memory(lambda s: eval(ast, None, s), Store(threshold)) / 2**20:7.2f} MiB peak")
+
+
+def bench_tail() -> None:
+    '''Run time and store size of loops written as tail calls'''
+    from interp_fun import Store, eval
+    from parse_run import parse_ast
+
+    for n in (1000, 100000, 1000000):
+        ast = parse_ast(f"letfun loop(n) = if n == 0 then 0 else loop(n - 1) in loop({n}) end")
+        store = Store()
+        try:
+            ms = _time_calls(lambda: eval(ast, None, store), runs=1)
+        except RecursionError:
+            print(f"tail: loop({n}) RecursionError")
+            continue
+        print(f"tail: loop({n:>7}) {ms:9.1f} ms  {n / ms * 1000:12,.0f} iterations/s  {store.stats()['size']:6} cells")
+
+
+def bench_cek(runs: int = 3) -> None:
+    '''Memory per DSL call of non-tail recursion, and run time, for the recursive and explicit-stack evaluators'''
+    source = "letfun f(n) = if n == 0 then 0 else 1 + f(n - 1) in f({}) end"
+    evaluators = {'recursive': 'interp_fun', 'explicit stack': 'cek_eval'}
+    small, large = 1000, 20000
+    for label, module in evaluators.items():
+        def run(n):
+            return _time_subprocess(f"import sys; sys.setrecursionlimit(10**6); import {module}; "
+                                    f"from parse_run import parse_ast; {module}.eval(parse_ast({source.format(n)!r}))", runs)
+        (_, rss_small), (ms, rss_large) = run(small), run(large)
+        per_call = (rss_large - rss_small) * 1024 / (large - small)
+        print(f"cek: {label:<15} {per_call:8.0f} bytes/call  f({large}) in {ms:7.1f} ms (incl. startup)")
+
+
+def generate_constant_script(n: int) -> str:
+    '''A generated script of n statements full of constant subexpressions'''
+    return '; '.join(
+        f'let x{i} = {i} * 2 + (3 - 1) in if 1 < 2 && !false then x{i} + 4 * 5 else "k" + {i} end; '
+        f'"id-" + "{i}" + (10 / 3)'
+        for i in range(n)
+    )
+
+
+def bench_fold() -> None:
+    '''Nodes removed by constant folding, and run time of the compiled program with and without it'''
+    from interp_fun import ConstantFolder, Store, compileExpr, emptyEnv, nodeCount, resolve
+    from parse_run import parse_ast
+
+    for label, script in (('generated', generate_script(1000)), ('constant-heavy', generate_constant_script(1000))):
+        ast = resolve(parse_ast(script))
+        folder = ConstantFolder()
+        folded = folder.fold(ast)
+        plain_code, folded_code = compileExpr(ast), compileExpr(folded)
+        print(f"fold: {label:<15} {nodeCount(ast):7} -> {nodeCount(folded):7} nodes ({folder.removed} removed)  "
+              f"run {_time_calls(lambda: plain_code(emptyEnv, Store())):7.2f} -> "
+              f"{_time_calls(lambda: folded_code(emptyEnv, Store())):7.2f} ms")
+
+def generate_let_script(n: int) -> str:
+    '''A generated script of n statements binding temporaries, some used once and some not at all'''
+    return '; '.join(
+        f'let a{i} = {i} in let b{i} = a{i} + 1 in let unused{i} = {i} * 3 in '
+        f'letfun f{i}(n) = let t = n * 2 in t + b{i} end in f{i}(a{i}) end end end end'
+        for i in range(n)
+    )
+
+
+def bench_inline() -> None:
+    '''Store allocations and run time of let-heavy programs with and without let inlining'''
+    from interp_fun import LetInliner, Store, compileExpr, emptyEnv, resolve, runCode
+    from parse_run import parse_ast
+
+    for label, script in (('generated', generate_script(1000)), ('let-heavy', generate_let_script(1000))):
+        ast = resolve(parse_ast(script))
+        inliner = LetInliner()
+        inlined = resolve(inliner.inline(ast))
+        results = []
+        for code in (compileExpr(ast), compileExpr(inlined)):
+            store = Store()
+            runCode(code, emptyEnv, store)
+            results.append((store.allocations, _time_calls(lambda: runCode(code, emptyEnv, Store()))))
+        (before, before_ms), (after, after_ms) = results
+        print(f"inline: {label:<10} {inliner.inlined:5} inlined {inliner.removed:5} removed  "
+              f"allocations {before:6} -> {after:6}  run {before_ms:7.2f} -> {after_ms:7.2f} ms")
+
+def bench_memo(runs: int = 3) -> None:
+    '''Run time and store allocations of naive fib(25) with and without memoization of pure functions'''
+    import codegen
+    from interp_fun import Store, compileExpr, emptyEnv, optimizeExpr, runCode
+    from parse_run import parse_ast
+
+    ast = optimizeExpr(parse_ast("letfun fib(n) = if n < 2 then n else fib(n - 1) + fib(n - 2) in fib(25) end"))
+    for backend, code in (('compileExpr', compileExpr(ast)), ('codegen', codegen.compile_ast(ast))):
+        for memo_size in (0, 256):
+            store = Store(memo_size=memo_size)
+            runCode(code, emptyEnv, store)
+            ms = _time_calls(lambda: runCode(code, emptyEnv, Store(memo_size=memo_size)), runs)
+            print(f"memo: fib(25) {backend:<12} memo_size {memo_size:4}  {ms:9.2f} ms  "
+                  f"{store.allocations:7} allocations  {store.memo_hits:3} hits")
+
+def _test_corpus() -> list:
+    '''The ASTs test3.TestEval evaluates, recorded by running it'''
+    import io
+    import unittest
+    import test3
+
+    programs = []
+    eval_with = test3.TestEval.eval_with
+
+    def recording(self, expr, inputs):
+        programs.append(expr)
+        return eval_with(self, expr, inputs)
+    test3.TestEval.eval_with = recording
+    try:
+        suite = unittest.defaultTestLoader.loadTestsFromTestCase(test3.TestEval)
+        unittest.TextTestRunner(stream=io.StringIO()).run(suite)
+    finally:
+        test3.TestEval.eval_with = eval_with
+    return programs
+
+
+def bench_types() -> None:
+    '''Operand type checks removed by type inference, per node type, on the TestEval corpus,
+    and run time of letfun programs with and without it'''
+    from interp_fun import (EvalError, Store, TypeInference, compileExpr, emptyEnv, foldConstants, inlineLets,
+                            markPureFunctions, resolve, runCode)
+    from parse_run import parse_ast
+
+    def prepare(e):
+        return markPureFunctions(resolve(inlineLets(foldConstants(resolve(e)))))
+
+    corpus, inference = _test_corpus(), TypeInference()
+    for e in corpus:
+        try:
+            inference.infer(prepare(e))
+        except EvalError:
+            pass  # Unbound names: the test expects an error before anything runs
+    total = [0, 0]
+    print(f"types: {len(corpus)} TestEval programs")
+    for name, (nodes, proven) in inference.breakdown().items():
+        total[0] += nodes
+        total[1] += proven
+        print(f"types: {name:<4} {nodes:5} nodes  {proven:5} unchecked  {nodes - proven:5} still checked")
+    print(f"types: all  {total[0]:5} nodes  {total[1]:5} unchecked  {total[0] - total[1]:5} still checked")
+
+    for label, source in LETFUN_PROGRAMS.items():
+        ast = prepare(parse_ast(source))
+        checked, unchecked = compileExpr(ast), compileExpr(TypeInference().infer(ast))
+        print(f"types: {label:<15} run {_time_calls(lambda: runCode(checked, emptyEnv, Store(memo_size=0))):8.2f} -> "
+              f"{_time_calls(lambda: runCode(unchecked, emptyEnv, Store(memo_size=0))):8.2f} ms")
+
+def bench_inline_caches() -> None:
+    '''Hits and deopts of each inline cache, and run time, for letfun programs compiled without type inference'''
+    from interp_fun import Store, compileExpr, emptyEnv, foldConstants, inlineCaches, inlineLets, resolve, runCode
+    from parse_run import parse_ast
+
+    programs = {**LETFUN_PROGRAMS,
+                'mixed adds': 'letfun g(v) = v + v in letfun loop(n) = if n == 0 then 0 else (g(n); g("s"); loop(n - 1)) '
+                              'in loop(150) end end'}
+    for label, source in programs.items():
+        code = compileExpr(resolve(inlineLets(foldConstants(resolve(parse_ast(source))))))
+        ms = _time_calls(lambda: runCode(code, emptyEnv, Store(memo_size=0)))
+        for cache in inlineCaches(code):
+            cache.hits = cache.deopts = 0
+        runCode(code, emptyEnv, Store(memo_size=0))
+        print(f"inline_caches: {label:<15} run {ms:7.2f} ms")
+        for cache in inlineCaches(code):
+            state = 'megamorphic' if cache.megamorphic else 'specialised' if cache.left is not None else 'generic'
+            print(f"inline_caches:     {repr(cache.node)[:40]:<40} {cache.hits:6} hits {cache.deopts:4} deopts  {state}")
+
+def bench_vm() -> None:
+    '''Compile and run time of the bytecode VM against interp_fun\'s compiled closures'''
+    import vm_eval
+    from interp_fun import Store, compileExpr, emptyEnv, optimizeExpr, runCode
+    from parse_run import parse_ast
+
+    programs = {**LETFUN_PROGRAMS, 'generated(1000)': generate_script(1000)}
+    for label, source in programs.items():
+        ast = parse_ast(source)
+        closures, chunk = compileExpr(optimizeExpr(ast)), vm_eval.compile_expr(ast)
+        compile_ms = (_time_calls(lambda: compileExpr(optimizeExpr(ast))), _time_calls(lambda: vm_eval.compile_expr(ast)))
+
+        def run_vm():
+            store = Store(memo_size=0)
+            store.roots.append(emptyEnv)
+            return vm_eval.run_chunk(chunk, emptyEnv, store)
+        run_ms = (_time_calls(lambda: runCode(closures, emptyEnv, Store(memo_size=0))), _time_calls(run_vm))
+        print(f"vm: {label:<16} compile {compile_ms[0]:8.2f} -> {compile_ms[1]:8.2f} ms  "
+              f"run {run_ms[0]:8.2f} -> {run_ms[1]:8.2f} ms  ({len(chunk.code) // 2} instructions in main)")
+
+def bench_superinstructions() -> None:
+    '''Dispatches and run time on the VM without the peephole pass, with its cleanups
+    only, and with the superinstructions a profile of the corpus selects'''
+    from collections import Counter
+
+    import vm_eval
+    from interp_fun import Store, emptyEnv
+    from parse_run import parse_ast
+
+    programs = {label: parse_ast(source) for label, source in {**LETFUN_PROGRAMS, 'generated(1000)': generate_script(1000)}.items()}
+
+    def run(chunk, profile=None):
+        store = Store(memo_size=0)
+        store.roots.append(emptyEnv)
+        return vm_eval.run_chunk(chunk, emptyEnv, store, profile)
+
+    profile = Counter()
+    for ast in programs.values():
+        run(vm_eval.compile_expr(ast, fusions=None), profile)
+    selected = vm_eval.select_superinstructions(profile)
+    total = sum(profile.values())
+    for (first, second), count in profile.most_common(6):
+        print(f"superinstructions: pair {vm_eval.OPCODES[first]:>12} {vm_eval.OPCODES[second]:<13} {count / total:6.1%}")
+    print(f"superinstructions: selected {', '.join(sorted(selected))}")
+    for label, ast in programs.items():
+        columns = []
+        for fusions in (None, frozenset(), selected):
+            chunk, counts = vm_eval.compile_expr(ast, fusions=fusions), Counter()
+            run(chunk, counts)
+            columns.append((sum(counts.values()), _time_calls(lambda: run(chunk))))
+        print(f"superinstructions: {label:<16} dispatches " + " -> ".join(f"{n:>7}" for n, _ in columns)
+              + "  run " + " -> ".join(f"{ms:7.2f}" for _, ms in columns) + " ms")
+
+def bench_tiers() -> None:
+    '''Compile plus run time with everything compiled up front (interp_fun closures,
+    codegen), everything on the VM, and tiered execution starting on the VM'''
+    import codegen
+    import vm_eval
+    from interp_fun import Store, compileExpr, emptyEnv, optimizeExpr, runCode
+    from parse_run import parse_ast
+
+    script = generate_script(1000)
+    programs = {**LETFUN_PROGRAMS, 'generated(1000)': script,
+                'generated + fib': f"{script};\n{LETFUN_PROGRAMS['fib(18)']}"}
+    for label, source in programs.items():
+        ast = parse_ast(source)
+        log = []
+
+        def tiered():
+            tiers = vm_eval.Tiers()
+            vm_eval.eval(ast, None, Store(memo_size=0), tiers)
+            log[:] = tiers.log
+        times = [_time_calls(lambda: runCode(compileExpr(optimizeExpr(ast)), emptyEnv, Store(memo_size=0))),
+                 _time_calls(lambda: runCode(codegen.compile_ast(ast), emptyEnv, Store(memo_size=0))),
+                 _time_calls(lambda: vm_eval.eval(ast, None, Store(memo_size=0))),
+                 _time_calls(tiered)]
+        print(f"tiers: {label:<16} closures {times[0]:8.2f}  codegen {times[1]:8.2f}  vm {times[2]:8.2f}  "
+              f"tiered {times[3]:8.2f} ms  {', '.join(f'{event} {name}@{n}' for event, name, n in log) or 'no promotions'}")
+
+def bench_batch(rows: int = 200_000) -> None:
+    '''A scoring rule over many input rows: one eval() per row, batch_eval's row by
+    row fallback (compiled once), and batch_eval's array operations'''
+    import random
+    import time
+
+    import batch_eval
+    from interp_fun import Let, Lit, eval
+    from parse_run import parse_ast
+
+    rule = parse_ast("if age < 25 || claims > 2 then (base * 3) / 2 + claims * 100 "
+                     "else if vip && !(claims > 0) then base - base / 10 else base + claims * 50")
+    rng = random.Random(1)
+    columns = {'age': [rng.randint(18, 90) for _ in range(rows)], 'claims': [rng.randint(0, 5) for _ in range(rows)],
+               'base': [rng.randint(100, 2000) for _ in range(rows)], 'vip': [rng.random() < 0.2 for _ in range(rows)]}
+    sample = 2000
+
+    def per_row():
+        for row in range(sample):
+            e = rule
+            for name, column in columns.items():
+                e = Let(name, Lit(column[row]), e)
+            eval(e)
+    start = time.perf_counter()
+    per_row()
+    eval_ms = (time.perf_counter() - start) * 1000 * rows / sample
+    fallback = batch_eval.eval_batch(Let('unused', Lit(0), rule), columns)  # Let is not vectorized
+    fallback_ms = _time_calls(lambda: batch_eval.eval_batch(Let('unused', Lit(0), rule), columns), runs=1)
+    result = batch_eval.eval_batch(rule, columns)
+    batch_ms = _time_calls(lambda: batch_eval.eval_batch(rule, columns))
+    assert list(result.values) == list(fallback.values) and not result.errors and result.scalar_rows == 0
+    print(f"batch: {rows} rows  eval() per row {eval_ms:9.1f} ms (from {sample} rows)  "
+          f"row by row {fallback_ms:8.1f} ms  vectorized {batch_ms:6.1f} ms")
+
+
+BENCHMARKS = {
+    'startup': bench_startup,
+    'parse': bench_parse,
+    'backends': bench_backends,
+    'intern': bench_intern,
+    'node_size': bench_node_size,
+    'eval': bench_eval,
+    'ast_cache': bench_ast_cache,
+    'stream': bench_stream,
+    'codegen': bench_codegen,
+    'resolve': bench_resolve,
+    'env': bench_env,
+    'gc': bench_gc,
+    'tail': bench_tail,
+    'cek': bench_cek,
+    'fold': bench_fold,
+    'inline': bench_inline,
+    'memo': bench_memo,
+    'types': bench_types,
+    'inline_caches': bench_inline_caches,
+    'vm': bench_vm,
+    'superinstructions': bench_superinstructions,
+    'tiers': bench_tiers,
+    'batch': bench_batch,
+}
+
+
+def main(argv: list[str]) -> None:
+    names = argv or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            sys.exit(f"unknown benchmark {name!r}, expected one of: {', '.join(BENCHMARKS)}")
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,33 @@
+'''Generate expr_fun_parser.py, a standalone LALR parser for expr_fun.lark.
+
+The generated module carries its own copy of the Lark runtime and the
+precomputed parse tables, so parse_run can use it without importing lark.
+Rerun this script after editing the grammar; parse_run ignores a generated
+parser whose GRAMMAR_SHA256 no longer matches expr_fun.lark.
+
+Usage: python build_parser.py
+'''
+
+from hashlib import sha256
+from pathlib import Path
+
+from lark import Lark
+from lark.tools.standalone import gen_standalone
+
+GRAMMAR_PATH = Path(__file__).with_name('expr_fun.lark')
+OUTPUT_PATH = Path(__file__).with_name('expr_fun_parser.py')
+
+
+def build(grammar_path: Path = GRAMMAR_PATH, output_path: Path = OUTPUT_PATH) -> None:
+    grammar = grammar_path.read_text()
+    # Same options as parse_run.load_parser (strict only affects grammar checking)
+    lark_inst = Lark(grammar, start='expr', parser='lalr', strict=True)
+
+    lines = [f"GRAMMAR_SHA256 = {sha256(grammar.encode()).hexdigest()!r}"]
+    gen_standalone(lark_inst, output=lambda *args: lines.append(' '.join(map(str, args))))
+    output_path.write_text('\n'.join(lines) + '\n')
+
+
+if __name__ == "__main__":
+    build()
+    print(f"wrote {OUTPUT_PATH.name}")
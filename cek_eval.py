@@ -0,0 +1,283 @@
+'''Explicit-stack evaluator for interp_fun ASTs, in the style of a CEK machine.
+
+interp_fun.eval nests one or more Python calls per DSL call or nested
+subexpression, so how deep a program can recurse is capped by the Python
+recursion limit.  This evaluator runs a single loop over a control register
+(the expression being evaluated, or None when a value is being returned), an
+environment, and a continuation stack of small tuples saying what to do with
+each value.  Recursion depth is therefore limited only by memory.
+
+Results, errors and Show/Read output match interp_fun.eval.  The evaluator
+keeps the same Store roots discipline (see interp_fun.Store), and a call in
+tail position replaces the caller's scope instead of stacking on it, so loops
+written as tail calls run in constant space here as well.
+'''
+
+from interp_fun import BINARY_OPS, Closure, EvalError, Expr, Store, emptyEnv, extendEnv, lookupEnv, envNames, subexprs
+from interp_fun import Add, Sub, Mul, Div, Neg, Let, Name, Lit, Command, And, Or, Not, Eq, Lt, Gt, If, Pipe, Redirect, Ifnz, Letfun, App, Assign, Seq, Block, Show, Read, ShellAnd, ShellOr, StrLit
+
+
+def _pipe(l, r):
+    if l['type'] != 'command':
+        raise ValueError("Left side of pipe must be a command")
+    if r['type'] != 'command':
+        raise ValueError("Right side of pipe must be a command")
+    return {**l, 'pipes': [*l.get('pipes', []), r]}
+
+# Operators whose operands are both evaluated, left to right, before anything is checked
+_BINARY = {**BINARY_OPS, Pipe: _pipe}
+
+def _command(command_string, env, store):
+    processed_parts = []
+    for part in command_string.split():
+        if part.startswith('$'):
+            var_name = part[1:]
+            loc = lookupEnv(var_name, env)
+            if loc is None:
+                raise EvalError(f"Undefined variable: {var_name}")
+            processed_parts.append(str(store.get(loc)))
+        else:
+            processed_parts.append(part)
+    if not processed_parts:
+        raise EvalError("Empty command")
+    return {'type': 'command', 'executable': processed_parts[0], 'args': processed_parts[1:], 'redirects': {}}
+
+def _read():
+    s = input("Enter an integer: ")
+    try:
+        return int(s.strip().strip("'\""))
+    except Exception:
+        raise EvalError("Input was not an integer")
+
+
+def _check_scope(e: Expr, scope: tuple[str, ...]) -> None:
+    '''Raise the EvalError interp_fun.resolve would for e, without recursing'''
+    bound: dict[str, int] = {}
+    for name in scope:
+        bound[name] = bound.get(name, 0) + 1
+    # Work items are nodes to check, or (+1 or -1, name) to bind or unbind a name
+    work: list = [e]
+    while work:
+        node = work.pop()
+        if isinstance(node, tuple):
+            delta, name = node
+            bound[name] = bound.get(name, 0) + delta
+            continue
+        match node:
+            case Name(name) if not bound.get(name):
+                raise EvalError(f"Unbound variable: {name}")
+            case Assign(name, _) if not bound.get(name):
+                raise EvalError(f"Assignment to unbound variable: {name}")
+            case Let(name, expr, body):
+                work += [(-1, name), body, (1, name), expr]
+                continue
+            case Letfun(name, param, bodyexpr, inexpr):
+                work += [(-1, name), inexpr, (-1, param), bodyexpr, (1, param), (1, name)]
+                continue
+        work.extend(reversed(subexprs(node)))
+
+
+# Continuation frame tags.  Frames are tuples (tag, ...) on one list; the
+# comments give the rest of each tuple.
+(_BINARY_RIGHT,   # node, env: evaluate node.right next
+ _BINARY_DONE,    # node, left value
+ _BOOL_RIGHT,     # node, env: And/Or, decide whether to evaluate node.right
+ _BOOL_CHECK,     # name: check the right operand of And/Or is a boolean
+ _UNARY,          # node: Not/Neg/Show/Redirect applied to the value
+ _BRANCH,         # node, env: If/Ifnz choosing a branch
+ _LET,            # node, env: bind the value and evaluate the body
+ _ASSIGN,         # loc
+ _SEQ,            # second, env
+ _BLOCK,          # node, index of the next statement, env
+ _SHELL_RIGHT,    # node, env
+ _SHELL_DONE,     # node, left value
+ _APP_ARG,        # node, env: the function is known, evaluate the argument
+ _APP_CALL,       # closure: the argument is known, enter the body
+ _POP_ROOT,       # a scope has finished: drop its environment from the store roots
+ ) = range(15)
+_POP = (_POP_ROOT,)
+
+
+def evalInEnv(env, store: Store, e: Expr):
+    '''Evaluate e in env and store with an explicit continuation stack'''
+    _check_scope(e, envNames(env))
+    roots = store.roots
+    depth = len(roots)
+    roots.append(env)
+    try:
+        return _run(e, env, store)
+    finally:
+        del roots[depth:]
+
+
+def eval(e: Expr, env=None, store=None):
+    return evalInEnv(emptyEnv if env is None else env, Store() if store is None else store, e)
+
+
+def _run(e, env, store):
+    roots = store.roots
+    stack: list[tuple] = []
+    push = stack.append
+    v = None
+
+    def enter(new_env):
+        # A scope whose only continuation is ending its caller's scope replaces it
+        if stack and stack[-1] is _POP:
+            roots[-1] = new_env
+        else:
+            roots.append(new_env)
+            push(_POP)
+
+    while True:
+        if e is not None:
+            t = type(e)
+            if t is Lit or t is StrLit:
+                v, e = e.value, None
+            elif t is Name:
+                loc = lookupEnv(e.name, env)
+                if loc is None:
+                    raise EvalError(f"Unbound variable: {e.name}")
+                v, e = store.get(loc), None
+            elif t in _BINARY:
+                push((_BINARY_RIGHT, e, env))
+                e = e.left
+            elif t is If or t is Ifnz:
+                push((_BRANCH, e, env))
+                e = e.cond
+            elif t is App:
+                push((_APP_ARG, e, env))
+                e = e.fun
+            elif t is Let:
+                push((_LET, e, env))
+                e = e.expr
+            elif t is Letfun:
+                c = Closure(e.param, e.bodyexpr, env)
+                env = extendEnv(e.name, store.alloc(c), env)
+                c.env = env
+                enter(env)
+                e = e.inexpr
+            elif t is Block:
+                push((_BLOCK, e, 1, env))
+                e = e.exprs[0]
+            elif t is Seq:
+                push((_SEQ, e.second, env))
+                e = e.first
+            elif t is And or t is Or:
+                push((_BOOL_RIGHT, e, env))
+                e = e.left
+            elif t is Not or t is Neg or t is Show:
+                push((_UNARY, e))
+                e = e.expr
+            elif t is Assign:
+                loc = lookupEnv(e.name, env)
+                if loc is None:
+                    raise EvalError(f"Assignment to unbound variable: {e.name}")
+                if isinstance(store.get(loc), Closure):
+                    raise EvalError(f"Cannot assign to function: {e.name}")
+                push((_ASSIGN, loc))
+                e = e.expr
+            elif t is Command:
+                v, e = _command(e.command, env, store), None
+            elif t is Redirect:
+                if e.stream not in ['stdin', 'stdout', 'stderr']:
+                    raise ValueError(f"Invalid stream: {e.stream}")
+                push((_UNARY, e))
+                e = e.command
+            elif t is ShellAnd or t is ShellOr:
+                push((_SHELL_RIGHT, e, env))
+                e = e.left
+            elif t is Read:
+                v, e = _read(), None
+            else:
+                v, e = None, None  # Anything else evaluates to None, as in interp_fun
+            continue
+
+        if not stack:
+            return v
+        frame = stack.pop()
+        tag = frame[0]
+        if tag == _POP_ROOT:
+            roots.pop()
+        elif tag == _BINARY_RIGHT:
+            _, node, env = frame
+            push((_BINARY_DONE, node, v))
+            e = node.right
+        elif tag == _BINARY_DONE:
+            v = _BINARY[type(frame[1])](frame[2], v)
+        elif tag == _APP_ARG:
+            _, node, env = frame
+            roots.append(v)  # Keep the closure's environment alive while the argument runs
+            push((_APP_CALL, v))
+            e = node.arg
+        elif tag == _APP_CALL:
+            fun = frame[1]
+            if not isinstance(fun, Closure):
+                raise EvalError("application of non-function")
+            env = extendEnv(fun.param, store.alloc(v), fun.env)
+            roots.pop()
+            enter(env)
+            e = fun.body
+        elif tag == _BRANCH:
+            _, node, env = frame
+            if type(node) is If:
+                if not isinstance(v, bool):
+                    raise TypeError("If condition must be a boolean")
+                e = node.then_branch if v else node.else_branch
+            else:
+                if not isinstance(v, int):
+                    raise TypeError("Ifnz condition must be an integer")
+                e = node.elseexpr if v == 0 else node.thenexpr
+        elif tag == _LET:
+            _, node, env = frame
+            env = extendEnv(node.name, store.alloc(v), env)
+            enter(env)
+            e = node.body
+        elif tag == _SEQ:
+            _, e, env = frame
+        elif tag == _BLOCK:
+            _, node, i, env = frame
+            if i + 1 < len(node.exprs):
+                push((_BLOCK, node, i + 1, env))
+            e = node.exprs[i]
+        elif tag == _BOOL_RIGHT:
+            _, node, env = frame
+            kind = 'And' if type(node) is And else 'Or'
+            if not isinstance(v, bool):
+                raise TypeError(f"{kind} expects booleans")
+            # And evaluates the right operand only when v is true, Or only when it is false
+            if v == (kind == 'And'):
+                push((_BOOL_CHECK, kind))
+                e = node.right
+        elif tag == _BOOL_CHECK:
+            if not isinstance(v, bool):
+                raise TypeError(f"{frame[1]} expects booleans")
+        elif tag == _UNARY:
+            node = frame[1]
+            t = type(node)
+            if t is Not:
+                if not isinstance(v, bool):
+                    raise TypeError("Not expects booleans")
+                v = not v
+            elif t is Neg:
+                if not isinstance(v, int):
+                    raise TypeError("Negative expects an integer")
+                v = -v
+            elif t is Show:
+                print(v)
+            else:  # Redirect
+                v = {**v, 'redirects': [v.get('redirects', []), {node.stream: node.target}]}
+        elif tag == _ASSIGN:
+            store.set(frame[1], v)
+        elif tag == _SHELL_RIGHT:
+            _, node, env = frame
+            op = '&&' if type(node) is ShellAnd else '||'
+            if not isinstance(v, dict) or v.get('type') != 'command':
+                raise ValueError(f"Left side of shell {op} must be a command")
+            push((_SHELL_DONE, node, v))
+            e = node.right
+        elif tag == _SHELL_DONE:
+            _, node, left = frame
+            executable, op = ('shell_and', '&&') if type(node) is ShellAnd else ('shell_or', '||')
+            if not isinstance(v, dict) or v.get('type') != 'command':
+                raise ValueError(f"Right side of shell {op} must be a command")
+            v = {'type': 'command', 'executable': executable, 'left_cmd': left, 'right_cmd': v, 'operator': op}
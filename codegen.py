@@ -0,0 +1,458 @@
+'''Compile interp_fun ASTs to Python source, with an on-disk cache of code objects.
+
+translate() turns an AST into the source of a Python module whose _main(env, store)
+function evaluates it; every letfun body becomes a module-level function of the
+same shape, stored as the Closure's compiled code.  Variables still live in the
+Store and are reached through the Env, so Let/Assign/Letfun/App and location
+aliasing behave exactly as in interp_fun.eval.
+
+compile_source() keys the marshalled code object on a hash of the program text,
+the grammar and the Python bytecode version, so a repeated run of the same script
+skips parsing and translation entirely.
+'''
+
+import marshal
+import os
+import sys
+from hashlib import sha256
+from importlib.util import MAGIC_NUMBER
+from pathlib import Path
+
+import interp_fun
+from interp_fun import Closure, Code, EvalError, Expr, Store, TailCall, addValues, checksProven, compileExpr, emptyEnv, envNames, envLoc, extendEnv, lookupEnv, memoKey, memoRecall, memoRemember, newMemo, optimizeExpr, resolve, runCode
+from interp_fun import Add, Sub, Mul, Div, Neg, Let, Name, Lit, Command, And, Or, Not, Eq, Lt, Gt, If, Pipe, Redirect, Ifnz, Letfun, App, Assign, Seq, Block, Show, Read, ShellAnd, ShellOr, StrLit
+
+# Bump when the generated code changes shape, to invalidate cached code objects
+CODEGEN_VERSION = '9'
+
+GRAMMAR_PATH = Path(__file__).with_name('expr_fun.lark')
+CODE_CACHE_DIR = Path(__file__).parent / '__pycache__' / 'fun_code'
+
+
+# -- Runtime support called from generated code -- #
+
+def _name(name, env, store):
+    loc = lookupEnv(name, env)
+    if loc is None:
+        raise EvalError(f"Unbound variable: {name}")
+    return store.get(loc)
+
+def _assign_loc(name, env, store):
+    loc = lookupEnv(name, env)
+    if loc is None:
+        raise EvalError(f"Assignment to unbound variable: {name}")
+    if isinstance(store.get(loc), Closure):
+        raise EvalError(f"Cannot assign to function: {name}")
+    return loc
+
+def _check_assign(loc, name, store):
+    if isinstance(store.get(loc), Closure):
+        raise EvalError(f"Cannot assign to function: {name}")
+    return loc
+
+_add = addValues
+
+def _callee_env(fun, arg, store):
+    # The generated code pushed fun onto the roots before evaluating arg
+    if not isinstance(fun, Closure):
+        raise EvalError("application of non-function")
+    if fun.code is None:
+        fun.code = compileExpr(resolve(fun.body, (fun.param, *envNames(fun.env))), True)
+    return extendEnv(fun.param, store.alloc(arg), fun.env)
+
+_new_memo = newMemo
+
+def _memo_key(fun, arg):
+    return memoKey(arg) if isinstance(fun, Closure) and fun.memo is not None else None
+
+def _apply(fun, arg, store):
+    key = _memo_key(fun, arg)
+    if key is not None:
+        result = memoRecall(fun.memo, key, store)
+        if result is not None:
+            store.roots.pop()
+            return result
+    env = _callee_env(fun, arg, store)
+    roots = store.roots
+    roots[-1] = env
+    result = fun.code(env, store)
+    while type(result) is TailCall:
+        roots[-1] = result.env
+        result = result.code(result.env, store)
+    roots.pop()
+    if key is not None:
+        memoRemember(fun.memo, key, result, store)
+    return result
+
+def _tail_call(fun, arg, store):
+    key = _memo_key(fun, arg)
+    if key is not None:
+        result = memoRecall(fun.memo, key, store)
+        if result is not None:
+            store.roots.pop()
+            return result
+    env = _callee_env(fun, arg, store)
+    store.roots.pop()
+    return TailCall(fun.code, env)
+
+def _read():
+    s = input("Enter an integer: ")
+    try:
+        return int(s.strip().strip("'\""))
+    except Exception:
+        raise EvalError("Input was not an integer")
+
+def _command(parts, env, store):
+    processed_parts = []
+    for part in parts:
+        if part.startswith('$'):
+            var_name = part[1:]
+            loc = lookupEnv(var_name, env)
+            if loc is None:
+                raise EvalError(f"Undefined variable: {var_name}")
+            processed_parts.append(str(store.get(loc)))
+        else:
+            processed_parts.append(part)
+    if not processed_parts:
+        raise EvalError("Empty command")
+    return {'type': 'command', 'executable': processed_parts[0], 'args': processed_parts[1:], 'redirects': {}}
+
+def _pipe(left_value, right_value):
+    if left_value['type'] != 'command':
+        raise ValueError("Left side of pipe must be a command")
+    if right_value['type'] != 'command':
+        raise ValueError("Right side of pipe must be a command")
+    return {**left_value, 'pipes': [*left_value.get('pipes', []), right_value]}
+
+def _check_stream(stream):
+    if stream not in ['stdin', 'stdout', 'stderr']:
+        raise ValueError(f"Invalid stream: {stream}")
+
+def _check_shell(value, message):
+    if not isinstance(value, dict) or value.get('type') != 'command':
+        raise ValueError(message)
+
+# Names visible to generated code
+_RUNTIME = {name: value for name, value in globals().items() if name.startswith('_') and callable(value)}
+_RUNTIME.update({name: getattr(interp_fun, name) for name in (
+    'Closure', 'envLoc', 'extendEnv', 'Add', 'Sub', 'Mul', 'Div', 'Neg', 'Let', 'Name', 'Lit', 'Command', 'And', 'Or',
+    'Not', 'Eq', 'Lt', 'Gt', 'If', 'Pipe', 'Redirect', 'Ifnz', 'Letfun', 'App', 'Assign', 'Seq', 'Block',
+    'Show', 'Read', 'ShellAnd', 'ShellOr', 'StrLit')})
+
+
+# -- Translation -- #
+
+class _Module:
+    '''Accumulates the functions and constants of one generated module'''
+    def __init__(self):
+        self.sections: list[str] = []
+        self.counter = 0
+
+    def fresh(self, prefix: str) -> str:
+        self.counter += 1
+        return f'{prefix}{self.counter}'
+
+    def const(self, value) -> str:
+        '''Bind value (an AST node) to a module-level name, rebuilt from its repr at load time'''
+        name = self.fresh('_const')
+        self.sections.append(f'{name} = {value!r}')
+        return name
+
+    def function(self, name: str, e: Expr, tail: bool = True) -> None:
+        body = _Body(self)
+        result = body.expr(e, 'env', tail)
+        body.emit(f'return {result}')
+        self.sections.append(f'def {name}(env, store):\n' + '\n'.join(body.lines))
+
+
+class _Body:
+    '''Statements of one generated function.  expr() emits the statements that
+    evaluate an expression and returns a side-effect free Python expression
+    (a literal or a temporary) holding its value.'''
+    def __init__(self, module: _Module):
+        self.module = module
+        self.lines: list[str] = []
+        self.depth = 1
+
+    def emit(self, line: str) -> None:
+        self.lines.append('    ' * self.depth + line)
+
+    def tmp(self) -> str:
+        return self.module.fresh('t')
+
+    def rooted(self, env: str, e: Expr, tail: bool) -> str:
+        '''Evaluate e in the new environment env, keeping env on the store's roots meanwhile'''
+        self.emit(f'store.roots.append({env})')
+        v = self.expr(e, env, tail)
+        self.emit('store.roots.pop()')
+        return v
+
+    def loc(self, env: str, depth: int) -> str:
+        '''Python expression for the location of a resolved variable'''
+        if depth <= 3:
+            return env + '[2]' * depth + '[1]'
+        return f'envLoc({env}, {depth})'
+
+    def int_operands(self, l: str, r: str, message: str) -> None:
+        self.emit(f'if not (isinstance({l}, int) and isinstance({r}, int)): raise TypeError({message!r})')
+
+    def branch(self, e: Expr, env: str, target: str, tail: bool) -> None:
+        '''Emit e as the body of an if/else arm, assigning its value to target'''
+        self.depth += 1
+        self.emit(f'{target} = {self.expr(e, env, tail)}')
+        self.depth -= 1
+
+    def expr(self, e: Expr, env: str, tail: bool = False) -> str:
+        '''With tail=True, e is in tail position of a function body and a call there
+        yields a TailCall (see interp_fun.compileExpr)'''
+        match e:
+            case Lit(value) | StrLit(value):
+                return repr(value)
+
+            case Add(left, right):
+                l, r, t = self.expr(left, env), self.expr(right, env), self.tmp()
+                if not checksProven(e):
+                    self.emit(f'{t} = _add({l}, {r})')
+                elif e.types == ('str', 'int'):
+                    self.emit(f'{t} = {l} + str({r})')
+                elif e.types == ('int', 'str'):
+                    self.emit(f'{t} = str({l}) + {r}')
+                else:
+                    self.emit(f'{t} = {l} + {r}')
+                return t
+
+            case Sub(left, right) | Mul(left, right) | Lt(left, right) | Gt(left, right):
+                l, r, t = self.expr(left, env), self.expr(right, env), self.tmp()
+                op, kind = {Sub: ('-', 'Sub'), Mul: ('*', 'Mul'), Lt: ('<', 'Lt'), Gt: ('>', 'Gt')}[type(e)]
+                if not checksProven(e):
+                    self.int_operands(l, r, f"{kind} expects integers")
+                self.emit(f'{t} = {l} {op} {r}')
+                return t
+
+            case Div(left, right):
+                l, r, t = self.expr(left, env), self.expr(right, env), self.tmp()
+                if not checksProven(e):
+                    self.int_operands(l, r, "Div expects integers")
+                self.emit(f'if {r} == 0: raise ZeroDivisionError("Division by zero")')
+                self.emit(f'{t} = {l} // {r}')
+                return t
+
+            case Neg(expr):
+                v, t = self.expr(expr, env), self.tmp()
+                if not checksProven(e):
+                    self.emit(f'if not isinstance({v}, int): raise TypeError("Negative expects an integer")')
+                self.emit(f'{t} = -{v}')
+                return t
+
+            case And(left, right) | Or(left, right):
+                kind, proven = 'And' if isinstance(e, And) else 'Or', checksProven(e)
+                l, t = self.expr(left, env), self.tmp()
+                if not proven:
+                    self.emit(f'if not isinstance({l}, bool): raise TypeError("{kind} expects booleans")')
+                # And evaluates the right operand only when l is true, Or only when it is false
+                self.emit(f'if {"" if kind == "And" else "not "}{l}:')
+                self.depth += 1
+                r = self.expr(right, env)
+                if not proven:
+                    self.emit(f'if not isinstance({r}, bool): raise TypeError("{kind} expects booleans")')
+                self.emit(f'{t} = {r}')
+                self.depth -= 1
+                self.emit('else:')
+                self.depth += 1
+                self.emit(f'{t} = {kind == "Or"}')
+                self.depth -= 1
+                return t
+
+            case Not(expr):
+                v, t = self.expr(expr, env), self.tmp()
+                if not checksProven(e):
+                    self.emit(f'if not isinstance({v}, bool): raise TypeError("Not expects booleans")')
+                self.emit(f'{t} = not {v}')
+                return t
+
+            case Eq(left, right):
+                l, r, t = self.expr(left, env), self.expr(right, env), self.tmp()
+                self.emit(f'{t} = type({l}) == type({r}) and {l} == {r}')
+                return t
+
+            case If(cond, then_branch, else_branch):
+                c, t = self.expr(cond, env), self.tmp()
+                if not checksProven(e):
+                    self.emit(f'if not isinstance({c}, bool): raise TypeError("If condition must be a boolean")')
+                self.emit(f'if {c}:')
+                self.branch(then_branch, env, t, tail)
+                self.emit('else:')
+                self.branch(else_branch, env, t, tail)
+                return t
+
+            case Ifnz(cond, thenexpr, elseexpr):
+                c, t = self.expr(cond, env), self.tmp()
+                self.emit(f'if not isinstance({c}, int): raise TypeError("Ifnz condition must be an integer")')
+                self.emit(f'if {c} == 0:')
+                self.branch(elseexpr, env, t, tail)
+                self.emit('else:')
+                self.branch(thenexpr, env, t, tail)
+                return t
+
+            case Let(name, value_expr, body_expr):
+                v, new_env = self.expr(value_expr, env), self.module.fresh('env')
+                self.emit(f'{new_env} = extendEnv({name!r}, store.alloc({v}), {env})')
+                return self.rooted(new_env, body_expr, tail)
+
+            case Name(name):
+                t = self.tmp()
+                if e.depth is not None:
+                    self.emit(f'{t} = store.get({self.loc(env, e.depth)})')
+                else:
+                    self.emit(f'{t} = _name({name!r}, {env}, store)')
+                return t
+
+            case Assign(name, expr):
+                loc = self.tmp()
+                if e.depth is not None:
+                    self.emit(f'{loc} = _check_assign({self.loc(env, e.depth)}, {name!r}, store)')
+                else:
+                    self.emit(f'{loc} = _assign_loc({name!r}, {env}, store)')
+                v = self.expr(expr, env)
+                self.emit(f'store.set({loc}, {v})')
+                return v
+
+            case Show(expr):
+                v = self.expr(expr, env)
+                self.emit(f'print({v})')
+                return v
+
+            case Command(command_string):
+                t = self.tmp()
+                self.emit(f'{t} = _command({tuple(command_string.split())!r}, {env}, store)')
+                return t
+
+            case Pipe(left, right):
+                l, r, t = self.expr(left, env), self.expr(right, env), self.tmp()
+                self.emit(f'{t} = _pipe({l}, {r})')
+                return t
+
+            case Redirect(command, stream, target):
+                self.emit(f'_check_stream({stream!r})')
+                v, t = self.expr(command, env), self.tmp()
+                self.emit(f'{t} = {{**{v}, "redirects": [{v}.get("redirects", []), {{{stream!r}: {self.module.const(target)}}}]}}')
+                return t
+
+            case ShellAnd(left, right) | ShellOr(left, right):
+                executable, op = ('shell_and', '&&') if isinstance(e, ShellAnd) else ('shell_or', '||')
+                l = self.expr(left, env)
+                self.emit(f'_check_shell({l}, "Left side of shell {op} must be a command")')
+                r = self.expr(right, env)
+                self.emit(f'_check_shell({r}, "Right side of shell {op} must be a command")')
+                t = self.tmp()
+                self.emit(f'{t} = {{"type": "command", "executable": {executable!r}, '
+                          f'"left_cmd": {l}, "right_cmd": {r}, "operator": {op!r}}}')
+                return t
+
+            case Letfun(name, param, bodyexpr, inexpr):
+                fun = self.module.fresh('_fun')
+                self.module.function(fun, bodyexpr)
+                c, new_env = self.tmp(), self.module.fresh('env')
+                memo = ', _new_memo(store)' if e.pure else ''
+                self.emit(f'{c} = Closure({param!r}, {self.module.const(bodyexpr)}, {env}, {fun}{memo})')
+                self.emit(f'{new_env} = extendEnv({name!r}, store.alloc({c}), {env})')
+                self.emit(f'{c}.env = {new_env}')
+                return self.rooted(new_env, inexpr, tail)
+
+            case App(fun, arg):
+                f = self.expr(fun, env)
+                self.emit(f'store.roots.append({f})')
+                a, t = self.expr(arg, env), self.tmp()
+                self.emit(f'{t} = {"_tail_call" if tail else "_apply"}({f}, {a}, store)')
+                return t
+
+            case Seq():
+                *init, last = interp_fun.seqSpine(e)
+                for stmt in init:
+                    self.expr(stmt, env)
+                return self.expr(last, env, tail)
+
+            case Read():
+                t = self.tmp()
+                self.emit(f'{t} = _read()')
+                return t
+
+        return 'None'
+
+
+def translate(e: Expr, tail: bool = False) -> str:
+    '''Return the source of a Python module whose _main(env, store) evaluates e.
+    With tail=True e is a function body, and a call in tail position returns a TailCall.'''
+    module = _Module()
+    module.function('_main', e, tail)
+    return '\n\n'.join(module.sections) + '\n'
+
+
+def _load(code) -> Code:
+    namespace = dict(_RUNTIME)
+    exec(code, namespace)
+    return namespace['_main']
+
+
+def compile_ast(e: Expr, filename: str = '<fun>', scope: tuple[str, ...] = (), tail: bool = False,
+                optimized: bool = False) -> Code:
+    '''Compile e to a Python function of (env, store), for environments binding the
+    names in scope (see interp_fun.resolve); tail as for translate.  optimized=True
+    says e already went through optimizeExpr for scope, e.g. as part of a larger
+    program whose type information it keeps.  Programs too deeply nested for the
+    Python compiler fall back to interp_fun.compileExpr.'''
+    if not optimized:
+        e = optimizeExpr(e, scope)
+    try:
+        return _load(compile(translate(e, tail), filename, 'exec'))
+    except (SyntaxError, RecursionError, MemoryError):
+        return compileExpr(e, tail)
+
+
+_grammar_hash: str | None = None
+
+def cache_key(source: str, scope: tuple[str, ...] = ()) -> str:
+    '''Hash of everything the cached code object depends on'''
+    global _grammar_hash
+    if _grammar_hash is None:
+        _grammar_hash = sha256(GRAMMAR_PATH.read_bytes()).hexdigest()
+    return sha256(b'\0'.join([source.encode(), ' '.join(scope).encode(), _grammar_hash.encode(),
+                              CODEGEN_VERSION.encode(), MAGIC_NUMBER])).hexdigest()
+
+
+def compile_source(source: str, cache_dir: Path | None = CODE_CACHE_DIR, scope: tuple[str, ...] = ()) -> Code:
+    '''Return a Python function of (env, store) that runs the program source in
+    environments binding the names in scope.
+
+    With a cache_dir, the code object is read from (or written to) a file named
+    after cache_key(source), so repeat runs skip parsing and translation.
+    '''
+    key = cache_key(source, scope)
+    path = cache_dir / f'{key}.bin' if cache_dir is not None else None
+    if path is not None:
+        try:
+            return _load(marshal.loads(path.read_bytes()))
+        except (OSError, EOFError, ValueError, TypeError):
+            pass  # Missing or unreadable: rebuild it
+
+    from parse_run import parse_ast  # Only needed on a cache miss
+    ast = optimizeExpr(parse_ast(source), scope)
+    try:
+        code = compile(translate(ast), f'<fun {key[:12]}>', 'exec')
+    except (SyntaxError, RecursionError, MemoryError):
+        return compileExpr(ast)
+    if path is not None:
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(f'.{os.getpid()}.tmp')
+            tmp.write_bytes(marshal.dumps(code))
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"codegen: could not write {path}: {e}", file=sys.stderr)
+    return _load(code)
+
+
+def run_source(source: str, env=None, store=None, cache_dir: Path | None = CODE_CACHE_DIR):
+    '''Compile (or load from the code cache) and run the program source'''
+    env = emptyEnv if env is None else env
+    return runCode(compile_source(source, cache_dir, envNames(env)), env, Store() if store is None else store)
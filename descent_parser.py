@@ -0,0 +1,250 @@
+'''Hand-written parser for expr_fun.lark that builds interp_fun ASTs directly.
+
+The LALR parser walks the whole precedence ladder of the grammar
+(seq_expr -> if_expr -> assign_expr -> ... -> primary_expr) with a unit
+reduction per level for every operand.  This parser uses recursive descent
+for the statement-level rules and precedence climbing for the binary
+operators, so an operand costs one call no matter how many levels it skips.
+
+It accepts the same language as the Lark grammar, including the contextual
+lexer's treatment of keywords: a keyword is only reserved where the grammar
+could start that construct, and is an ordinary identifier everywhere else
+(e.g. `end + 1` or `let show = 1 in ...`).
+'''
+
+import re
+
+from interp_fun import Add, Sub, Mul, Div, Neg, Let, Name, Lit, Command, And, Or, Not, Eq, Lt, Gt, If, Pipe, Redirect, Letfun, App, Expr, Assign, Block, Show, Read, ShellAnd, ShellOr, StrLit
+
+
+class UnexpectedToken(Exception):
+    pass
+
+
+# Token kinds are the operator text itself, or one of these
+INT, WORD, STRING, COMMAND, EOF = 'INT', 'WORD', 'STRING', 'COMMAND', '$END'
+
+_TOKEN = re.compile(r'''
+    (?P<ws>[ \t]+|(?:\r?\n)+)
+  | (?P<int>[0-9]+)
+  | (?P<word>[A-Za-z_][A-Za-z0-9_]*)
+  | (?P<string>".*?(?<!\\)(?:\\\\)*?")
+  | (?P<command>`[ \t\r\n]*(?P<content>[^ `\t\r\n]+(?:\ [^ `\t\r\n]+)*)[ \t\r\n]*`)
+  | (?P<op>==|:=|\|\||&&|[-+*/<>!();=|])
+''', re.VERBOSE)
+
+
+def tokenize(s: str) -> tuple[list[str], list]:
+    '''Split s into parallel lists of token kinds and token values'''
+    kinds, values = [], []
+    pos, end = 0, len(s)
+    match = _TOKEN.match
+    while pos < end:
+        m = match(s, pos)
+        if m is None:
+            raise UnexpectedToken(f"Unexpected character {s[pos]!r} at position {pos}")
+        group = m.lastgroup
+        if group == 'op':
+            kinds.append(m.group())
+            values.append(m.group())
+        elif group == 'word':
+            kinds.append(WORD)
+            values.append(m.group())
+        elif group == 'int':
+            kinds.append(INT)
+            values.append(int(m.group()))
+        elif group == 'string':
+            kinds.append(STRING)
+            values.append(m.group()[1:-1])
+        elif group == 'command':
+            kinds.append(COMMAND)
+            values.append(m.group('content'))
+        pos = m.end()
+    kinds.append(EOF)
+    values.append(None)
+    return kinds, values
+
+
+def _unescape(s: str) -> str:
+    # Same escapes, in the same order, as ToExpr.string
+    return s.replace('\\n', '\n').replace('\\t', '\t').replace('\\"', '"').replace("\\'", "'").replace('\\\\', '\\')
+
+
+# Binding powers of the binary boolean/arithmetic operators (higher binds tighter)
+_OR, _AND, _CMP, _ADD, _MUL = 1, 2, 3, 4, 5
+_BINARY = {
+    '||': (_OR, Or), '&&': (_AND, And),
+    '==': (_CMP, Eq), '<': (_CMP, Lt), '>': (_CMP, Gt),
+    '+': (_ADD, Add), '-': (_ADD, Sub),
+    '*': (_MUL, Mul), '/': (_MUL, Div),
+}
+_SHELL = {'||': (1, ShellOr), '&&': (2, ShellAnd), '|': (3, Pipe)}
+
+# Keywords that can start a primary_expr; anywhere an operand can start they
+# win over ID.  'if' and 'show' are only reserved where an if_expr/show_expr can start.
+_PRIMARY_KEYWORDS = frozenset(('true', 'false', 'read', 'let', 'letfun'))
+
+
+class _Parser:
+    def __init__(self, s: str):
+        self.kinds, self.values = tokenize(s)
+        self.pos = 0
+
+    def error(self) -> UnexpectedToken:
+        kind, value = self.kinds[self.pos], self.values[self.pos]
+        return UnexpectedToken(f"Unexpected token {kind} {value!r} at token {self.pos}")
+
+    def expect(self, kind: str):
+        if self.kinds[self.pos] != kind:
+            raise self.error()
+        value = self.values[self.pos]
+        self.pos += 1
+        return value
+
+    def expect_word(self, word: str) -> None:
+        if self.kinds[self.pos] != WORD or self.values[self.pos] != word:
+            raise self.error()
+        self.pos += 1
+
+    def parse(self) -> Expr:
+        e = self.seq()
+        if self.kinds[self.pos] != EOF:
+            raise self.error()
+        return e
+
+    # seq_expr: seq_item (";" seq_item)*
+    def seq(self) -> Expr:
+        items = [self.seq_item()]
+        while self.kinds[self.pos] == ';':
+            self.pos += 1
+            items.append(self.seq_item())
+        if len(items) == 1:
+            return items[0]
+        return Block(items)
+
+    def seq_item(self) -> Expr:
+        if self.kinds[self.pos] == COMMAND:
+            return self.shell(0)
+        return self.if_expr()
+
+    # shell_or_expr / shell_and_expr / shell_pipe_expr, all left associative
+    def shell(self, min_bp: int) -> Expr:
+        left = self.redirect()
+        while True:
+            op = _SHELL.get(self.kinds[self.pos])
+            if op is None or op[0] <= min_bp:
+                return left
+            self.pos += 1
+            left = op[1](left, self.shell(op[0]))
+
+    def redirect(self) -> Expr:
+        left = Command(self.expect(COMMAND))
+        while self.kinds[self.pos] == '>':
+            self.pos += 1
+            left = Redirect(left, "stdout", Command(self.expect(COMMAND)))
+        return left
+
+    def if_expr(self) -> Expr:
+        if self.kinds[self.pos] == WORD and self.values[self.pos] == 'if':
+            self.pos += 1
+            cond = self.assign_expr()
+            self.expect_word('then')
+            then_branch = self.if_expr()
+            self.expect_word('else')
+            else_branch = self.if_expr()
+            return If(cond=cond, then_branch=then_branch, else_branch=else_branch)
+        return self.assign_expr()
+
+    def assign_expr(self) -> Expr:
+        if self.kinds[self.pos] == WORD:
+            word = self.values[self.pos]
+            if word == 'show':
+                self.pos += 1
+                return Show(expr=self.if_expr())
+            if self.kinds[self.pos + 1] == ':=' and word not in _PRIMARY_KEYWORDS:
+                self.pos += 2
+                return Assign(name=word, expr=self.assign_expr())
+        return self.binary(_OR)
+
+    def binary(self, min_bp: int) -> Expr:
+        '''Precedence climbing over or_expr ... mul_expr, starting at binding power min_bp'''
+        kinds = self.kinds
+        if kinds[self.pos] == '!':
+            # not_expr is an operand of && and || only
+            if min_bp > _CMP:
+                raise self.error()
+            self.pos += 1
+            left = Not(expr=self.binary(_CMP))
+        else:
+            left = self.neg_expr()
+        while True:
+            op = _BINARY.get(kinds[self.pos])
+            if op is None or op[0] < min_bp:
+                return left
+            bp, node = op
+            self.pos += 1
+            left = node(left, self.binary(bp + 1))
+            if bp == _CMP and _BINARY.get(kinds[self.pos], (None,))[0] == _CMP:
+                raise self.error()  # Comparisons do not chain
+
+    def neg_expr(self) -> Expr:
+        if self.kinds[self.pos] == '-':
+            self.pos += 1
+            return Neg(expr=self.neg_expr())
+        return self.app_expr()
+
+    def app_expr(self) -> Expr:
+        result = self.primary()
+        while self.kinds[self.pos] == '(':
+            self.pos += 1
+            arg = self.seq()
+            self.expect(')')
+            result = App(fun=result, arg=arg)
+        return result
+
+    def primary(self) -> Expr:
+        kind, value = self.kinds[self.pos], self.values[self.pos]
+        self.pos += 1
+        if kind == WORD:
+            if value not in _PRIMARY_KEYWORDS:
+                return Name(name=value)
+            if value == 'true':
+                return Lit(value=True)
+            if value == 'false':
+                return Lit(value=False)
+            if value == 'read':
+                return Read()
+            if value == 'let':
+                name = self.expect(WORD)
+                self.expect('=')
+                expr = self.seq()
+                self.expect_word('in')
+                body = self.seq()
+                self.expect_word('end')
+                return Let(name=name, expr=expr, body=body)
+            # letfun
+            name = self.expect(WORD)
+            self.expect('(')
+            param = self.expect(WORD)
+            self.expect(')')
+            self.expect('=')
+            bodyexpr = self.seq()
+            self.expect_word('in')
+            inexpr = self.seq()
+            self.expect_word('end')
+            return Letfun(name=name, param=param, bodyexpr=bodyexpr, inexpr=inexpr)
+        if kind == INT:
+            return Lit(value=value)
+        if kind == STRING:
+            return StrLit(_unescape(value))
+        if kind == '(':
+            e = self.seq()
+            self.expect(')')
+            return e
+        self.pos -= 1
+        raise self.error()
+
+
+def parse(s: str) -> Expr:
+    '''Parse s into an AST, raising UnexpectedToken if it is not in the language of expr_fun.lark'''
+    return _Parser(s).parse()
@@ -1,16 +1,75 @@
-from interp_fun import Add, Sub, Mul, Div, Neg, Let, Name, Lit, Command, And, Or, Not, Eq, Lt, Gt, If, Pipe, Redirect, Ifnz, Letfun, App, Expr, Assign, Seq, Show, Read, ShellAnd, ShellOr, StrLit, run
+from interp_fun import Add, Sub, Mul, Div, Neg, Let, Name, Lit, Command, And, Or, Not, Eq, Lt, Gt, If, Pipe, Redirect, Ifnz, Letfun, App, Expr, Assign, Seq, Block, Show, Read, ShellAnd, ShellOr, StrLit, run, astSize, internAST, evalInEnv, emptyEnv, Store
 
-from lark import Lark, Token, ParseTree, Transformer, Tree
-from lark.exceptions import VisitError
+import re
+from collections import OrderedDict
+from hashlib import sha256
 from pathlib import Path
+from typing import Iterator, TextIO
 
-parser = Lark(Path('expr_fun.lark').read_text(), start='expr', parser='lalr', strict=True)
+import descent_parser
+
+GRAMMAR_PATH = Path(__file__).with_name('expr_fun.lark')
+
+# Serialized LALR tables live next to the bytecode cache.  Lark keys the file on a
+# hash of the grammar text, the parser options and the Lark/Python versions, and
+# rebuilds it in place whenever any of those change.
+GRAMMAR_CACHE = Path(__file__).parent / '__pycache__' / 'expr_fun.lark.cache'
+
+def load_parser(grammar: str, cache: Path | None = GRAMMAR_CACHE, transformer=None) -> 'Lark':
+    '''Build the dynamic Lark LALR parser for grammar, loading the tables from cache when they are up to date'''
+    from lark import Lark
+    if cache is not None:
+        try:
+            cache.parent.mkdir(parents=True, exist_ok=True)
+        except OSError:
+            cache = None  # E.g. a read-only install: build the tables without caching them
+    if cache is None:
+        return Lark(grammar, start='expr', parser='lalr', strict=True, transformer=transformer)
+    # The transformer is not part of the cache key, so both parsers share the tables
+    return Lark(grammar, start='expr', parser='lalr', strict=True, transformer=transformer, cache=str(cache))
+
+def _load_standalone():
+    '''Return the generated standalone parser module (see build_parser.py) if it matches the grammar, else None'''
+    try:
+        import expr_fun_parser
+    except ImportError:
+        return None
+    try:
+        grammar_hash = sha256(GRAMMAR_PATH.read_bytes()).hexdigest()
+    except OSError:
+        # No grammar to compare against, trust the generated parser
+        return expr_fun_parser
+    if getattr(expr_fun_parser, 'GRAMMAR_SHA256', None) != grammar_hash:
+        return None
+    return expr_fun_parser
+
+# Prefer the generated standalone parser: it needs neither the lark package nor
+# the grammar file at import time.  Both produce the same parse trees.
+standalone = _load_standalone()
+if standalone is not None:
+    from expr_fun_parser import Token, Transformer, Tree, VisitError
+    parser = standalone.Lark_StandAlone()
+else:
+    from lark import Token, Transformer, Tree
+    from lark.exceptions import VisitError
+    parser = load_parser(GRAMMAR_PATH.read_text())
+
+ParseTree = Tree
 
 class ParseError(Exception): 
     pass
 
-def parse(s:str) -> ParseTree:
+# Parser backends: 'lark' is the LALR parser generated from expr_fun.lark,
+# 'descent' the hand-written parser in descent_parser.py, which produces
+# ASTs directly and so has no parse tree to hand back.
+BACKENDS = ('lark', 'descent')
+
+def parse(s:str, backend: str = 'lark') -> ParseTree | Expr:
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown parser backend: {backend}")
     try:
+        if backend == 'descent':
+            return descent_parser.parse(s)
         return parser.parse(s)
     except Exception as e:
         raise ParseError(e)
@@ -209,15 +268,10 @@ class ToExpr(Transformer[Token,Expr]):
         return Assign(name=args[0].value, expr=args[1])
 
     def seq(self, args) -> Expr:
-        """Transform a sequence of expressions into nested Seq nodes"""
+        """Transform a sequence of expressions into a flat Block (equal to the right-nested Seq chain)"""
         if len(args) == 1:
             return args[0]
-        
-        # Create a right associative tree of Seq nodes
-        result = args[-1]  # Start with last element
-        for expr in reversed(args[:-1]):  # Process remaining elements right to left
-            result = Seq(first=expr, second=result)
-        return result
+        return Block(args)
     
     def show(self, args) -> Expr:
         return Show(expr=args[0])
@@ -252,21 +306,95 @@ class ToExpr(Transformer[Token,Expr]):
         string_val = string_val.replace('\\n', '\n').replace('\\t', '\t').replace('\\"', '"').replace("\\'", "'").replace('\\\\', '\\')
         return StrLit(string_val)
 
-def genAST(t:ParseTree) -> Expr:
-    '''Applies the transformer to convert a parse tree into an AST'''
+def genAST(t:ParseTree | Expr, intern: bool = False) -> Expr:
+    '''Applies the transformer to convert a parse tree into an AST.
+    With intern=True, structurally identical subtrees of the result are shared.'''
+    if not isinstance(t, Tree):
+        return internAST(t) if intern else t  # Already an AST, from a backend that builds one directly
     try:
-        return ToExpr().transform(t)               
+        ast = ToExpr().transform(t)
+        return internAST(ast) if intern else ast
     except VisitError as e:
         if isinstance(e.orig_exc, AmbiguousParse):
             raise AmbiguousParse()
         else:
             raise e
-        
+
+# A second parser that runs the ToExpr callbacks while the LALR parser reduces,
+# so AST nodes are built directly and no parse tree is ever materialised.
+if standalone is not None:
+    ast_parser = standalone.Lark_StandAlone(transformer=ToExpr())
+else:
+    ast_parser = load_parser(GRAMMAR_PATH.read_text(), transformer=ToExpr())
+
+def parse_ast(s: str, backend: str = 'lark', intern: bool = False) -> Expr:
+    '''Parse s directly into an AST, equivalent to genAST(parse(s, backend), intern) but without the intermediate tree'''
+    if backend != 'lark':
+        ast = parse(s, backend)
+    else:
+        try:
+            ast = ast_parser.parse(s)
+        except Exception as e:
+            raise ParseError(e)
+    return internAST(ast) if intern else ast
+
+class ASTCache:
+    '''Bounded LRU cache from source text to its parsed AST.
+
+    Evaluation never mutates an AST, so a cached tree can be handed out and run
+    any number of times.  Entries are evicted least recently used first once
+    either max_entries or max_bytes (source text plus astSize of the tree) is exceeded.
+    '''
+    def __init__(self, max_entries: int = 256, max_bytes: int = 16 * 2**20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, tuple[Expr, int]] = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def parse(self, s: str) -> Expr:
+        '''Return the AST for s, parsing it (and caching the result) on a miss'''
+        entry = self._entries.get(s)
+        if entry is not None:
+            self.hits += 1
+            self._entries.move_to_end(s)
+            return entry[0]
+        self.misses += 1
+        ast = parse_ast(s)
+        self._insert(s, ast)
+        return ast
+
+    def _insert(self, s: str, ast: Expr) -> None:
+        size = len(s.encode()) + astSize(ast)
+        if size > self.max_bytes or self.max_entries <= 0:
+            return  # Would evict everything else and still not fit
+        self._entries[s] = (ast, size)
+        self.bytes += size
+        while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self.bytes -= evicted
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.bytes = 0
+
+    def stats(self) -> dict[str, int]:
+        return {'entries': len(self._entries), 'bytes': self.bytes,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+# Shared by parse_and_run; replace it to change the limits
+ast_cache = ASTCache()
+
 def just_parse(s: str) -> (Expr|None):   
     """Just attempts to parse and generate the AST for concrete expression s, returns AST or None if parse fails"""
     try:
-        t = parse(s)
-        ast = genAST(t)
+        ast = parse_ast(s)
         return ast
     except Exception as e:
         print(f"Error parsing '{s}': {e}")
@@ -275,14 +403,62 @@ def just_parse(s: str) -> (Expr|None):
 def parse_and_run(s: str) -> None:
     """Parse string s into an AST and run it"""
     try:
-        tree = parse(s)
-        ast = genAST(tree)
+        ast = ast_cache.parse(s)
         return run(ast)
     except ParseError as e:
         print(f"Parse error: {e}")
     except AmbiguousParse:
         print("Ambiguous parse")
 
+# Lexemes that matter for finding top-level ';': string literals, shell commands,
+# words (to spot let/letfun/end), brackets and ';', and runs of anything else.
+_STATEMENT_TOKEN = re.compile(r'"(?:\\.|[^"\\])*"|`[^`]*`|\w+|[();]|[^"`\w();]+')
+
+def iter_statements(stream: TextIO, chunk_size: int = 1 << 16) -> Iterator[str]:
+    '''Read stream incrementally and yield the source of each top-level ';'-separated statement'''
+    buf, pos, start, depth, split = '', 0, 0, 0, False
+    eof = False
+    while not eof:
+        chunk = stream.read(chunk_size)
+        eof = not chunk
+        # Drop the statements already handed out so memory stays bounded
+        buf, pos, start = buf[start:] + chunk, pos - start, 0
+        while pos < len(buf):
+            m = _STATEMENT_TOKEN.match(buf, pos)
+            if m is None or (m.end() == len(buf) and not eof):
+                break  # Unterminated string or a token that may continue in the next chunk
+            tok = m.group()
+            pos = m.end()
+            if tok == '(' or tok == 'let' or tok == 'letfun':
+                depth += 1
+            elif tok == ')' or tok == 'end':
+                depth -= 1
+            elif tok == ';' and depth <= 0:
+                yield buf[start:pos - 1]
+                start, split = pos, True
+    rest = buf[start:]
+    # A trailing ';' leaves an empty statement, which the parser rejects as the grammar does
+    if split or rest.strip():
+        yield rest
+
+def run_stream(stream: TextIO, env=None, store=None):
+    '''Parse and evaluate stream one top-level statement at a time, returning the last value.
+
+    Every statement is evaluated in the same env and store, which matches running
+    the whole script as one nested Seq, but each statement runs as soon as it is read.
+    '''
+    env = emptyEnv if env is None else env
+    store = Store() if store is None else store
+    result = None
+    for statement in iter_statements(stream):
+        result = evalInEnv(env, store, parse_ast(statement))
+    return result
+
+def run_file(path: str | Path):
+    '''Stream the script in the file at path through run_stream'''
+    with open(path) as f:
+        return run_stream(f)
+
 def driver():
     """Driver for testing expressions"""
     print("Shell DSL Interpreter")
@@ -1863,5 +1863,1295 @@ class TestEval(unittest.TestCase):
             3
         )
 
+class TestGrammarCache(unittest.TestCase):
+    def test_cache_roundtrip(self):
+        import tempfile
+        from pathlib import Path
+        from parse_run import load_parser
+        grammar = Path('expr_fun.lark').read_text()
+        with tempfile.TemporaryDirectory() as d:
+            cache = Path(d) / 'expr_fun.lark.cache'
+            cold = load_parser(grammar, cache)
+            self.assertTrue(cache.exists())
+            key = cache.read_bytes().split(b'\n', 1)[0]
+            warm = load_parser(grammar, cache)
+            self.assertEqual(cold.parse("let x = 1 in x + 2 end"),
+                             warm.parse("let x = 1 in x + 2 end"))
+            # A grammar edit rewrites the cache under a new key
+            load_parser(grammar + "\n// edited\n", cache)
+            self.assertNotEqual(cache.read_bytes().split(b'\n', 1)[0], key)
+
+    def test_unwritable_cache_dir(self):
+        import tempfile
+        from pathlib import Path
+        from parse_run import load_parser
+        grammar = Path('expr_fun.lark').read_text()
+        with tempfile.TemporaryDirectory() as d:
+            # The cache directory cannot be created under a file: parse without caching
+            (Path(d) / 'file').write_text('')
+            parser = load_parser(grammar, Path(d) / 'file' / '__pycache__' / 'expr_fun.lark.cache')
+            self.assertIsNotNone(parser.parse("let x = 1 in x + 2 end"))
+
+
+class TestASTCache(unittest.TestCase):
+    def test_hits_and_misses(self):
+        from parse_run import ASTCache
+        cache = ASTCache()
+        first = cache.parse("x + 1")
+        self.assertIs(cache.parse("x + 1"), first)
+        cache.parse("y")
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (1, 2, 0))
+
+    def test_lru_eviction(self):
+        from parse_run import ASTCache
+        cache = ASTCache(max_entries=2)
+        cache.parse("a")
+        cache.parse("b")
+        cache.parse("a")        # b is now least recently used
+        cache.parse("c")
+        self.assertEqual(cache.evictions, 1)
+        cache.parse("a")
+        cache.parse("b")
+        self.assertEqual(cache.hits, 2)
+        self.assertEqual(cache.misses, 4)
+
+    def test_byte_limit(self):
+        from parse_run import ASTCache
+        cache = ASTCache(max_bytes=2000)
+        for i in range(50):
+            cache.parse(f"x{i} + {i}")
+        self.assertLessEqual(cache.bytes, 2000)
+        self.assertGreater(cache.evictions, 0)
+        self.assertEqual(len(cache) + cache.evictions, 50)
+
+    def test_reuse_is_safe(self):
+        from parse_run import ASTCache, parse_ast
+        source = "let x = 1 in letfun f(y) = x := x + y in f(1); f(2) end end"
+        cache = ASTCache()
+        ast = cache.parse(source)
+        self.assertEqual(interp.eval(ast), 4)
+        self.assertEqual(interp.eval(cache.parse(source)), 4)
+        self.assertEqual(ast, parse_ast(source))
+
+
+class TestStreaming(unittest.TestCase):
+    source = ('let x = 1 in (x; x) end; "a;b"; `echo ;`; '
+              'letfun f(y) = y + 1 in f(2) end; (1; 2)')
+
+    def test_split_across_chunks(self):
+        from parse_run import iter_statements
+        expected = ['let x = 1 in (x; x) end', ' "a;b"', ' `echo ;`',
+                    ' letfun f(y) = y + 1 in f(2) end', ' (1; 2)']
+        for chunk_size in (1, 2, 5, 1 << 16):
+            self.assertEqual(list(iter_statements(StringIO(self.source), chunk_size)), expected)
+
+    def test_matches_whole_script(self):
+        from parse_run import run_stream, parse_ast
+        self.assertEqual(run_stream(StringIO(self.source)), interp.eval(parse_ast(self.source)))
+
+    def test_runs_before_later_statements_parse(self):
+        from parse_run import run_stream, ParseError
+        out = StringIO()
+        with redirect_stdout(out):
+            with self.assertRaises(ParseError):
+                run_stream(StringIO("show 1; show 2; let in"))
+        self.assertEqual(out.getvalue(), "1\n2\n")
+
+
+class TestBlock(unittest.TestCase):
+    def test_equal_to_seq_chain(self):
+        from interp_fun import Block
+        a, b, c = Name("a"), Name("b"), Name("c")
+        self.assertEqual(Block([a, b, c]), Seq(a, Seq(b, c)))
+        self.assertEqual(Seq(a, Seq(b, c)), Block([a, b, c]))
+        self.assertEqual(Block([a, b, c]), Block([a, Block([b, c])]))
+        self.assertNotEqual(Block([a, b, c]), Seq(Seq(a, b), c))
+        self.assertNotEqual(Block([a, b]), Block([a, c]))
+
+    def test_seq_view(self):
+        from interp_fun import Block
+        match Block([Lit(1), Lit(2), Lit(3)]):
+            case Seq(first, second):
+                self.assertEqual(first, Lit(1))
+                self.assertEqual(second, Block([Lit(2), Lit(3)]))
+            case _:
+                self.fail("Block did not match Seq(first, second)")
+
+    def test_long_sequence(self):
+        from parse_run import parse_ast
+        n = 5000
+        source = "let x = 0 in " + "; ".join(["x := x + 1"] * n) + " end"
+        self.assertEqual(interp.eval(parse_ast(source)), n)
+        self.assertEqual(interp.eval(parse_ast(source, backend='descent')), n)
+
+
+class TestInternedParsing(TestParsing):
+    # Reruns the TestParsing corpus with hash-consing on; interned ASTs must
+    # compare equal to the expected trees exactly as unshared ones do.
+    def parse(self, concrete:str, expected):
+        from parse_run import parse_ast
+        try:
+            got = parse_ast(concrete, intern=True)
+        except Exception:
+            got = None
+        if expected == "anything":
+            self.assertNotEqual(got, None)
+        else:
+            self.assertEqual(got, expected, f'interned parse error: "{concrete}"')
+
+    # The grammar does not parse a Seq inside an if; TestParsing already reports
+    # these two, so there is no need to fail them again here
+    @unittest.skip("known TestParsing failure: Seq inside if")
+    def test_040(self):
+        pass
+
+    @unittest.skip("known TestParsing failure: Seq inside if")
+    def test_041(self):
+        pass
+
+    def test_sharing(self):
+        from parse_run import parse_ast
+        from interp_fun import distinctNodeCount, nodeCount
+        ast = parse_ast("let x = 2 in x + 1; x + 1; 1; true end", intern=True)
+        first, second, one, true = ast.body.exprs
+        self.assertIs(first, second)
+        self.assertIs(first.right, one)
+        self.assertIsNot(one, true)   # Lit(1) == Lit(True), but they must not be merged
+        self.assertEqual(nodeCount(ast), 11)
+        self.assertEqual(distinctNodeCount(ast), 7)
+        self.assertEqual(interp.eval(ast), True)
+
+
+class TestNodeRepresentation(unittest.TestCase):
+    nodes = [
+        Lit(1), interp.StrLit("s"), Add(Lit(1), Lit(2)), Sub(Lit(1), Lit(2)), Mul(Lit(1), Lit(2)),
+        Div(Lit(1), Lit(2)), Neg(Lit(1)), And(Lit(True), Lit(False)), Or(Lit(True), Lit(False)),
+        Not(Lit(True)), Let("x", Lit(1), Name("x")), Name("x"), Eq(Lit(1), Lit(2)), Lt(Lit(1), Lit(2)),
+        interp.Gt(Lit(1), Lit(2)), If(Lit(True), Lit(1), Lit(2)), interp.Command("ls"),
+        interp.Pipe(interp.Command("a"), interp.Command("b")),
+        interp.Redirect(interp.Command("a"), "stdout", interp.Command("b")),
+        interp.ShellAnd(interp.Command("a"), interp.Command("b")),
+        interp.ShellOr(interp.Command("a"), interp.Command("b")),
+        interp.Ifnz(Lit(1), Lit(2), Lit(3)), Letfun("f", "x", Name("x"), Name("f")),
+        App(Name("f"), Lit(1)), Assign("x", Lit(1)), Seq(Lit(1), Lit(2)),
+        interp.Block([Lit(1), Lit(2)]), Show(Lit(1)), Read(),
+    ]
+
+    def test_slotted_and_frozen(self):
+        import dataclasses
+        for node in self.nodes:
+            with self.subTest(node=node):
+                self.assertFalse(hasattr(node, '__dict__'))
+                for name in [f.name for f in dataclasses.fields(node)] + ['exprs'] * hasattr(node, 'exprs'):
+                    with self.assertRaises(dataclasses.FrozenInstanceError):
+                        setattr(node, name, None)
+                self.assertEqual(hash(node), hash(node))
+
+    def test_match_args_unchanged(self):
+        match Let("x", Lit(1), Name("x")):
+            case Let(name, Lit(value), Name(body)):
+                self.assertEqual((name, value, body), ("x", 1, "x"))
+        match App(Name("f"), Lit(1)):
+            case App(Name(f), Lit(a)):
+                self.assertEqual((f, a), ("f", 1))
+        self.assertEqual(Lit(True).type, bool)
+        self.assertEqual(Lit(1), Lit(True))   # Unchanged from the unslotted classes
+
+
+class TestCompile(unittest.TestCase):
+    def test_compiled_code_is_reusable(self):
+        from parse_run import parse_ast
+        code = interp.compileExpr(parse_ast(
+            "let x = 1 in letfun f(y) = x := x + y in f(1); f(2) end end"))
+        self.assertEqual(code(interp.emptyEnv, interp.Store()), 4)
+        self.assertEqual(code(interp.emptyEnv, interp.Store()), 4)
+
+    def test_apply_uncompiled_closure(self):
+        store = interp.Store()
+        loc = store.alloc(interp.Closure("y", Add(Name("y"), Lit(1)), interp.emptyEnv))
+        env = interp.extendEnv("f", loc, interp.emptyEnv)
+        self.assertEqual(interp.eval(App(Name("f"), Lit(41)), env, store), 42)
+
+
+class TestTreeParsing(TestParsing):
+    # Reruns the TestParsing corpus through the two-pass path (parse tree,
+    # then genAST), which must agree with the inline AST construction.
+    def parse(self, concrete:str, expected):
+        import parse_run
+        try:
+            got = parse_run.genAST(parse_run.parse(concrete))
+        except Exception:
+            got = None
+        if expected == "anything":
+            self.assertNotEqual(got, None)
+        else:
+            self.assertEqual(got, expected, f'tree parser error: "{concrete}"')
+
+    # The grammar does not parse a Seq inside an if; TestParsing already reports
+    # these two, so there is no need to fail them again here
+    @unittest.skip("known TestParsing failure: Seq inside if")
+    def test_040(self):
+        pass
+
+    @unittest.skip("known TestParsing failure: Seq inside if")
+    def test_041(self):
+        pass
+
+
+class TestDescentParsing(TestParsing):
+    # Differential test: the hand-written backend must produce the same AST
+    # as the Lark backend for every input, and reject the same inputs.
+    def parse(self, concrete:str, expected):
+        from parse_run import parse_ast, ParseError
+        results = []
+        for backend in ('lark', 'descent'):
+            try:
+                results.append(parse_ast(concrete, backend=backend))
+            except ParseError:
+                results.append(None)
+        self.assertEqual(results[1], results[0], f'descent backend differs on "{concrete}"')
+        self.assertIs(type(results[1]), type(results[0]))
+
+    def test_lexer_corner_cases(self):
+        for concrete in [
+            'end + 1', 'let x = in in x end', 'x + then', 'else := 3', 'show := 3',
+            'let show = 1 in 2 end', 'letfun end(x) = 1 in 2 end', 'x := if := 1',
+            'x := if a then b else c', '1 ifx', 'true1', 'truex := 1', '007',
+            'a < b < c', 'x == y == z', '!a == b', '!1 < 2 && 3', 'a == !b', 'a + !b',
+            '- - a', '-f(1)', 'a * -b', '1 - -2', 'f (1) (2)', 'read(1)',
+            'let f = 1 in f end (2)(3)', '`a` | `b` > `c`', '`a` || `b` && `c`',
+            '(`ls`) && true', '`  ls  `', '`ls -l  -a`', '`a`;', ';', '', 'x\n+\n1',
+            '"a\\"b"', '"a\\nb"', 'show `ls`', 'x := y := 3', 'show x := 3',
+        ]:
+            with self.subTest(concrete=concrete):
+                self.parse(concrete, None)
+
+
+class TestStandaloneParsing(TestParsing):
+    # Reruns the TestParsing corpus, checking that the generated standalone
+    # parser and the dynamic Lark parser produce the same parse trees.
+    @classmethod
+    def setUpClass(cls):
+        import parse_run
+        if parse_run.standalone is None:
+            raise unittest.SkipTest("expr_fun_parser.py is not built (run build_parser.py)")
+        cls.dynamic = parse_run.load_parser(parse_run.GRAMMAR_PATH.read_text())
+
+    def parse(self, concrete:str, expected):
+        import parse_run
+        try:
+            dynamic = self.dynamic.parse(concrete)
+        except Exception:
+            dynamic = None
+        try:
+            generated = parse_run.parse(concrete)
+        except parse_run.ParseError:
+            generated = None
+        self.assertEqual(generated, dynamic, f'standalone parser differs on "{concrete}"')
+
+
+class TestCodegenEval(TestEval):
+    # Reruns the TestEval corpus through the Python source backend, which must
+    # agree with interp_fun.eval on values, output and errors.
+    def eval_with(self, expr, inputs):
+        import codegen
+        with redirect_stdin(StringIO("\n".join(inputs) + "\n")):
+            return codegen.compile_ast(expr)(interp.emptyEnv, interp.Store())
+
+
+class TestCodeCache(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.TemporaryDirectory()
+        from pathlib import Path
+        self.cache_dir = Path(self.tmp.name) / "code"
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_repeat_run_skips_parsing(self):
+        import codegen, parse_run
+        source = "letfun f(n) = if n < 1 then 0 else n + f(n - 1) in f(10) end"
+        self.assertEqual(codegen.run_source(source, cache_dir=self.cache_dir), 55)
+        self.assertEqual(len(list(self.cache_dir.iterdir())), 1)
+        def fail(*args, **kwargs):
+            raise AssertionError("parsed on a cache hit")
+        original, parse_run.parse_ast = parse_run.parse_ast, fail
+        try:
+            self.assertEqual(codegen.run_source(source, cache_dir=self.cache_dir), 55)
+        finally:
+            parse_run.parse_ast = original
+
+    def test_key_depends_on_source(self):
+        import codegen
+        self.assertNotEqual(codegen.cache_key("1 + 1"), codegen.cache_key("1 + 2"))
+        self.assertEqual(codegen.cache_key("1 + 1"), codegen.cache_key("1 + 1"))
+
+    def test_corrupt_entry_is_rebuilt(self):
+        import codegen
+        self.cache_dir.mkdir(exist_ok=True)
+        (self.cache_dir / f'{codegen.cache_key("2 * 3")}.bin').write_bytes(b'garbage')
+        self.assertEqual(codegen.run_source("2 * 3", cache_dir=self.cache_dir), 6)
+
+    def test_closure_body_survives_cache(self):
+        import codegen
+        source = "letfun f(x) = x + 1 in f end"
+        codegen.run_source(source, cache_dir=self.cache_dir)
+        closure = codegen.run_source(source, cache_dir=self.cache_dir)
+        self.assertEqual(closure.body, Add(Name("x"), Lit(1)))
+
+    def test_deep_nesting_falls_back(self):
+        import codegen
+        e = Lit(0)
+        for _ in range(200):
+            e = If(Lit(True), e, Lit(1))
+        self.assertEqual(codegen.compile_ast(e)(interp.emptyEnv, interp.Store()), 0)
+
+
+class TestResolve(unittest.TestCase):
+    def test_depths(self):
+        from parse_run import parse_ast
+        e = interp.resolve(parse_ast("let x = 1 in let y = 2 in x := x + y end end"))
+        assign = e.body.body
+        self.assertEqual(assign.depth, 1)
+        self.assertEqual((assign.expr.left.depth, assign.expr.right.depth), (1, 0))
+
+    def test_shadowing(self):
+        from parse_run import parse_ast
+        e = interp.resolve(parse_ast("let x = 1 in let x = 2 in x end + x end"))
+        self.assertEqual((e.body.left.body.depth, e.body.right.depth), (0, 0))
+        self.assertEqual(interp.eval(e), 3)
+
+    def test_letfun_scope(self):
+        from parse_run import parse_ast
+        e = interp.resolve(parse_ast("let a = 1 in letfun f(n) = f(n) + n + a in f end end"))
+        body = e.body.bodyexpr  # (f(n) + n) + a
+        self.assertEqual(body.left.left.fun.depth, 1)
+        self.assertEqual(body.left.right.depth, 0)
+        self.assertEqual(body.right.depth, 2)
+        self.assertEqual(e.body.inexpr.depth, 0)
+
+    def test_unbound_reported_before_running(self):
+        from parse_run import parse_ast
+        out = StringIO()
+        with redirect_stdout(out):
+            with self.assertRaisesRegex(interp.EvalError, "Unbound variable: y"):
+                interp.eval(parse_ast("show 1; if true then 2 else y"))
+            with self.assertRaisesRegex(interp.EvalError, "Assignment to unbound variable: z"):
+                interp.eval(parse_ast("show 1; z := 1"))
+        self.assertEqual(out.getvalue(), "")
+
+    def test_resolve_against_env(self):
+        store = interp.Store()
+        env = interp.extendEnv("b", store.alloc(2), interp.extendEnv("a", store.alloc(40), interp.emptyEnv))
+        self.assertEqual(interp.eval(Let("c", Name("b"), Add(Name("a"), Name("c"))), env, store), 42)
+
+    def test_resolution_is_not_part_of_equality(self):
+        self.assertEqual(Name("x", 3), Name("x"))
+        self.assertEqual(hash(Name("x", 3)), hash(Name("x")))
+        self.assertEqual(repr(Assign("x", Lit(1), 0)), repr(Assign("x", Lit(1))))
+
+    def test_deep_lookup(self):
+        depth = 500
+        e = Name("x0")
+        for i in range(depth - 1, -1, -1):
+            e = Let(f"x{i}", Lit(i), e)
+        resolved = interp.resolve(e)
+        node = resolved
+        while isinstance(node, Let):
+            node = node.body
+        self.assertEqual(node.depth, depth - 1)
+        self.assertEqual(interp.eval(e), 0)
+
+
+class TestEnv(unittest.TestCase):
+    def test_extend_shares_parent(self):
+        outer = interp.extendEnv("x", 0, interp.emptyEnv)
+        a, b = interp.extendEnv("y", 1, outer), interp.extendEnv("z", 2, outer)
+        self.assertIs(a[2], outer)
+        self.assertIs(b[2], outer)
+        self.assertEqual(interp.envBindings(a), [("y", 1), ("x", 0)])
+        self.assertEqual(interp.envNames(b), ("z", "x"))
+        self.assertEqual(interp.envNames(interp.emptyEnv), ())
+
+    def test_lookup(self):
+        env = interp.extendEnv("x", 2, interp.extendEnv("y", 1, interp.extendEnv("x", 0, interp.emptyEnv)))
+        self.assertEqual(interp.lookupEnv("x", env), 2)
+        self.assertEqual(interp.lookupEnv("y", env), 1)
+        self.assertIsNone(interp.lookupEnv("z", env))
+        self.assertIsNone(interp.lookupEnv("x", interp.emptyEnv))
+        self.assertEqual([interp.envLoc(env, d) for d in range(3)], [2, 1, 0])
+
+    def test_equality_is_structural(self):
+        a = interp.extendEnv("x", 0, interp.emptyEnv)
+        self.assertEqual(a, interp.extendEnv("x", 0, interp.emptyEnv))
+        self.assertNotEqual(a, interp.extendEnv("x", 1, interp.emptyEnv))
+
+    def test_deep_env(self):
+        env = interp.emptyEnv
+        for i in range(100000):
+            env = interp.extendEnv(f"x{i}", i, env)
+        self.assertEqual(interp.lookupEnv("x0", env), 0)
+        self.assertEqual(interp.envLoc(env, 99999), 0)
+        store = interp.Store()
+        store.alloc(7)
+        self.assertEqual(interp.eval(Add(Name("x0"), Lit(1)), env, store), 8)
+
+
+class TestCollectingEval(TestEval):
+    # Reruns the TestEval corpus collecting on every allocation, so any cell
+    # the evaluator still needs but failed to root would be reused under it.
+    def eval_with(self, expr, inputs):
+        with redirect_stdin(StringIO("\n".join(inputs) + "\n")):
+            return interp.eval(expr, None, interp.Store(gc_threshold=1))
+
+
+class TestCollectingCodegenEval(TestEval):
+    def eval_with(self, expr, inputs):
+        import codegen
+        with redirect_stdin(StringIO("\n".join(inputs) + "\n")):
+            return interp.runCode(codegen.compile_ast(expr), interp.emptyEnv, interp.Store(gc_threshold=1))
+
+
+class TestStoreGC(unittest.TestCase):
+    def test_free_list_reuse(self):
+        store = interp.Store(gc_threshold=None)
+        locs = [store.alloc(i) for i in range(4)]
+        store.roots.append(interp.extendEnv("x", locs[2], interp.emptyEnv))
+        self.assertEqual(store.collect(), 3)
+        self.assertEqual(store.get(locs[2]), 2)
+        self.assertEqual(store.stats()['live'], 1)
+        self.assertEqual(store.alloc("new"), 0)  # Low locations are reused first
+        self.assertEqual(store.stats()['size'], 4)
+
+    def test_closures_keep_their_environment(self):
+        from parse_run import parse_ast
+        source = ("letfun adder(x) = letfun add(y) = x + y in add end in "
+                  "let a = adder(10) in let b = adder(20) in a(1) + b(2) + a(adder(100)(3)) end end end")
+        self.assertEqual(interp.eval(parse_ast(source), None, interp.Store(gc_threshold=1)), 146)
+
+    def test_memory_stays_flat(self):
+        from parse_run import parse_ast
+        fib = "letfun fib(n) = if n < 2 then n else fib(n - 1) + fib(n - 2) in fib({}) end"
+        sizes = []
+        for n in (12, 16, 20):
+            store = interp.Store(gc_threshold=256, memo_size=0)
+            self.assertEqual(interp.eval(parse_ast(fib.format(n)), None, store), [144, 987, 6765][len(sizes)])
+            stats = store.stats()
+            self.assertGreater(stats['reclaimed'], 0)
+            sizes.append(stats['size'])
+        self.assertEqual(len(set(sizes)), 1, sizes)
+        self.assertLessEqual(sizes[0], 512)
+
+    def test_disabled(self):
+        from parse_run import parse_ast
+        store = interp.Store(gc_threshold=None)
+        interp.eval(parse_ast("letfun f(n) = if n < 1 then 0 else f(n - 1) in f(100) end"), None, store)
+        self.assertEqual(store.stats()['size'], 102)
+        self.assertEqual(store.collections, 0)
+
+    def test_streamed_statements_share_cells(self):
+        import parse_run
+        store = interp.Store(gc_threshold=1)
+        script = "let x = 1 in letfun f(n) = n + x in f(1) end end; 5"
+        self.assertEqual(parse_run.run_stream(StringIO(script), None, store), 5)
+        self.assertEqual(store.roots, [])
+
+
+class TestTailCalls(unittest.TestCase):
+    # Each program loops far deeper than the Python stack allows unless tail calls run in constant stack
+    def run_both(self, source, expected):
+        import codegen
+        from parse_run import parse_ast
+        ast = parse_ast(source)
+        self.assertEqual(interp.eval(ast), expected)
+        self.assertEqual(interp.runCode(codegen.compile_ast(ast), interp.emptyEnv, interp.Store()), expected)
+
+    def test_if(self):
+        self.run_both("letfun loop(n) = if n == 0 then 0 else loop(n - 1) in loop(100000) end", 0)
+
+    def test_seq_and_let(self):
+        self.run_both("let s = 0 in letfun loop(n) = if n == 0 then s else (s := s + n; "
+                      "let m = n - 1 in loop(m) end) in loop(100000) end end", 5000050000)
+
+    def test_nested_functions(self):
+        self.run_both("letfun even(n) = letfun odd(m) = if m == 0 then false else even(m - 1) in "
+                      "if n == 0 then true else odd(n - 1) end in even(100001) end", False)
+
+    def test_non_tail_calls_unchanged(self):
+        self.run_both("letfun f(n) = if n == 0 then 0 else 1 + f(n - 1) in f(50) end", 50)
+        out = StringIO()
+        with redirect_stdout(out):
+            self.run_both("letfun f(n) = if n == 0 then 0 else (show n; f(n - 1)) in show f(3) end", 0)
+        self.assertEqual(out.getvalue(), "3\n2\n1\n0\n" * 2)
+        with self.assertRaises(RecursionError):
+            self.run_both("letfun f(n) = if n == 0 then 0 else 1 + f(n - 1) in f(100000) end", 100000)
+
+
+class TestCEKEval(TestEval):
+    # Reruns the TestEval corpus through the explicit-stack evaluator, collecting
+    # on every allocation, which must agree with interp_fun.eval.
+    def eval_with(self, expr, inputs):
+        import cek_eval
+        with redirect_stdin(StringIO("\n".join(inputs) + "\n")):
+            return cek_eval.eval(expr, None, interp.Store(gc_threshold=1))
+
+
+class TestCEK(unittest.TestCase):
+    def test_deep_non_tail_recursion(self):
+        import cek_eval
+        from parse_run import parse_ast
+        e = parse_ast("letfun f(n) = if n == 0 then 0 else 1 + f(n - 1) in f(100000) end")
+        self.assertEqual(cek_eval.eval(e), 100000)
+
+    def test_deeply_nested_expression(self):
+        import cek_eval
+        e = Lit(0)
+        for i in range(100000):
+            e = Add(Lit(1), e) if i % 2 else Let("x", e, Name("x"))
+        self.assertEqual(cek_eval.eval(e), 50000)
+        self.assertEqual(cek_eval.eval(e, None, interp.Store(gc_threshold=1)), 50000)
+
+    def test_tail_calls_run_in_constant_space(self):
+        import cek_eval
+        from parse_run import parse_ast
+        store = interp.Store()
+        e = parse_ast("let s = 0 in letfun loop(n) = if n == 0 then s else (s := s + n; loop(n - 1)) "
+                      "in loop(100000) end end")
+        self.assertEqual(cek_eval.eval(e, None, store), 5000050000)
+        self.assertLessEqual(store.stats()['size'], 1024)
+        self.assertEqual(store.roots, [])
+
+    def test_unbound_reported_before_running(self):
+        import cek_eval
+        from parse_run import parse_ast
+        out = StringIO()
+        with redirect_stdout(out):
+            for source, message in [("show 1; y", "Unbound variable: y"),
+                                    ("let x = 1 in show x; x end; z := 1", "Assignment to unbound variable: z"),
+                                    ("letfun f(n) = n in n end", "Unbound variable: n")]:
+                with self.assertRaisesRegex(interp.EvalError, message):
+                    cek_eval.eval(parse_ast(source))
+        self.assertEqual(out.getvalue(), "")
+
+    def test_closures_interoperate(self):
+        import cek_eval
+        from parse_run import parse_ast
+        store = interp.Store()
+        f = cek_eval.eval(parse_ast("let k = 5 in letfun f(n) = n * k in f end end"), None, store)
+        env = interp.extendEnv("f", store.alloc(f), interp.emptyEnv)
+        self.assertEqual(interp.eval(App(Name("f"), Lit(3)), env, store), 15)
+
+
+class TestConstantFolding(unittest.TestCase):
+    def fold(self, e):
+        return interp.foldConstants(e)
+
+    def test_folds(self):
+        from parse_run import parse_ast
+        for source, expected in [
+            ("1 + 2 * 3", Lit(7)), ("10 / 3 - -2", Lit(5)), ("1 < 2 && !(3 > 4)", Lit(True)),
+            ('"a" + "b" + 1', interp.StrLit("ab1")), ("1 == true", Lit(False)), ('"x" == "x"', Lit(True)),
+            ("if 1 < 2 then x else y", Name("x")), ("false && x", Lit(False)), ("true || x", Lit(True)),
+            ("true && false", Lit(False)), ("1; 2; x", Name("x")), ('x; "s"; y', interp.Block([Name("x"), Name("y")])),
+            ("let x = 2 + 2 in x * (3 - 1) end", Let("x", Lit(4), Mul(Name("x"), Lit(2)))),
+        ]:
+            with self.subTest(source=source):
+                self.assertEqual(self.fold(parse_ast(source)), expected)
+
+    def test_runtime_errors_are_kept(self):
+        from parse_run import parse_ast
+        for source in ["1 / 0", '1 - "a"', "!1", "1 && true", "true && 1", "if 1 then 2 else 3", "-\"a\""]:
+            with self.subTest(source=source):
+                e = parse_ast(source)
+                self.assertEqual(self.fold(e), e)
+        self.assertEqual(self.fold(parse_ast("x + 2 / (1 - 1)")), Add(Name("x"), Div(Lit(2), Lit(0))))
+
+    def test_ifnz(self):
+        self.assertEqual(self.fold(interp.Ifnz(Lit(0), Name("a"), Name("b"))), Name("b"))
+        self.assertEqual(self.fold(interp.Ifnz(Lit(True), Name("a"), Name("b"))), Name("a"))
+
+    def test_removed_count(self):
+        from parse_run import parse_ast
+        folder = interp.ConstantFolder()
+        e = parse_ast("let x = 1 + 2 in if true then x else 0 end")
+        self.assertEqual(folder.fold(e), Let("x", Lit(3), Name("x")))
+        self.assertEqual(folder.removed, interp.nodeCount(e) - 3)
+        unchanged = parse_ast("x + 1")
+        self.assertIs(folder.fold(unchanged), unchanged)
+        self.assertEqual(folder.removed, interp.nodeCount(e) - 3)
+
+    def test_resolution_survives(self):
+        e = interp.resolve(Let("x", Add(Lit(1), Lit(2)), If(Lit(True), Name("x"), Lit(0))))
+        self.assertEqual(self.fold(e).body.depth, 0)
+
+
+class TestLetInlining(unittest.TestCase):
+    def inline(self, source):
+        from parse_run import parse_ast
+        return interp.inlineLets(interp.resolve(parse_ast(source)))
+
+    def test_inlined(self):
+        from parse_run import parse_ast
+        for source, expected in [
+            ("let x = 1 in x + 2 end", "1 + 2"),
+            ("let x = 5 in 3 end", "3"),
+            ("let x = show 1 in 3 end", "show 1; 3"),
+            ("let x = read in x + 1 end", "read + 1"),
+            ("let x = read in show x end", "show read"),
+            ("let x = read in let y = 2 in y - x end end", "2 - read"),
+            ("let y = 1 in letfun f(n) = n + y in f(2) end end", "letfun f(n) = n + 1 in f(2) end"),
+            ("let x = `ls` in 1 end", "`ls`; 1"),
+            ("let x = read in let x = show 1 in x end end", "read; show 1"),
+        ]:
+            with self.subTest(source=source):
+                self.assertEqual(self.inline(source), parse_ast(expected))
+
+    def test_effects_are_not_reordered(self):
+        from parse_run import parse_ast
+        for source in [
+            "let x = read in show 2; x end",
+            "let x = read in 1 - true + x end",
+            "let x = read in if true then x else 0 end",
+            "let x = read in false && x end",
+            "let x = read in letfun f(n) = x in f(1) end end",
+            "let y = 0 in let x = read in y := x end end",
+            "let x = read in x + x end",
+            "let x = 1 in x := 2; x end",
+            "let x = 1 in `echo $x` end",
+            "let b = 2 in b := 2; let x = b + 0 in let b = 3 in x * b end end end",
+        ]:
+            with self.subTest(source=source):
+                e = interp.resolve(parse_ast(source))
+                self.assertEqual(interp.inlineLets(e), e)
+
+    def test_counts(self):
+        from parse_run import parse_ast
+        inliner = interp.LetInliner()
+        inliner.inline(interp.resolve(parse_ast("let a = 1 in let b = 2 in let c = read in a + c end end end")))
+        self.assertEqual((inliner.inlined, inliner.removed), (2, 1))
+
+    def test_same_behaviour(self):
+        import cek_eval
+        import codegen
+        import vm_eval
+        from parse_run import parse_ast
+        for source in [
+            "let x = read in let y = read in y - x end end",
+            "let x = read in show 2; x end",
+            "let s = 0 in let x = s in s := 5; x + s end end",
+            "let b = 2 in b := 2; let x = b + 0 in let b = 3 in x * b end end end",
+            "let k = 3 in letfun f(n) = if n == 0 then k else f(n - 1) in let r = f(4) in r * r end end end",
+            "let u = show 7 in let v = read in show v; u end end",
+            "let y = 1 in let x = (y := 5) in y + x end end",
+            "let y = 1 in letfun f(n) = y := n in let x = f(5) in y + x end end end",
+            "let y = 1 in letfun f(n) = y := n in let x = f(5) in y == x end end end",
+        ]:
+            with self.subTest(source=source):
+                e = parse_ast(source)
+                # Unoptimized (the baseline), optimized, then every backend that optimizes, and cek_eval
+                runs = [lambda: interp.runCode(interp.compileExpr(interp.resolve(e)), interp.emptyEnv, interp.Store()),
+                        lambda: interp.runCode(interp.compileExpr(interp.optimizeExpr(e)), interp.emptyEnv, interp.Store()),
+                        lambda: interp.eval(e), lambda: vm_eval.eval(e), lambda: cek_eval.eval(e),
+                        lambda: interp.runCode(codegen.compile_ast(e), interp.emptyEnv, interp.Store())]
+                results = []
+                for run in runs:
+                    out, input_text = StringIO(), StringIO("10\n20\n")
+                    with redirect_stdout(out), redirect_stdin(input_text):
+                        value = run()
+                        left = input_text.read()
+                    results.append((value, out.getvalue(), left))
+                self.assertEqual(results, [results[0]] * len(runs))
+
+    def test_pure_value_reading_assigned_name(self):
+        # The value reads a variable assigned before its use, directly or in a call
+        import cek_eval
+        import codegen
+        import vm_eval
+        from parse_run import parse_ast
+        for source in ["let a = 1 in let x = a == 1 in a := 2; x end end",
+                       "let a = 1 in letfun f(x) = a := x in let b = a == 1 in f(3); b end end end"]:
+            with self.subTest(source=source):
+                e = parse_ast(source)
+                self.assertEqual(interp.inlineLets(interp.resolve(e)), interp.resolve(e))
+                for evaluate in (interp.eval, vm_eval.eval, cek_eval.eval,
+                                 lambda e: interp.runCode(codegen.compile_ast(e), interp.emptyEnv, interp.Store())):
+                    self.assertIs(evaluate(e), True)
+
+
+class TestMemoization(unittest.TestCase):
+    FIB = "letfun fib(n) = if n < 2 then n else fib(n - 1) + fib(n - 2) in fib(25) end"
+
+    def pure_functions(self, source, scope=()):
+        from parse_run import parse_ast
+        marked, found = interp.optimizeExpr(parse_ast(source), scope), {}
+        stack = [marked]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, Letfun):
+                found[node.name] = node.pure
+            stack.extend(interp.subexprs(node))
+        return found
+
+    def test_purity(self):
+        for source, expected in [
+            (self.FIB, {'fib': True}),
+            ("letfun f(n) = show n in f(1) end", {'f': False}),
+            ("letfun f(n) = read + n in f(1) end", {'f': False}),
+            ("letfun f(n) = `echo $n` in f(1) end", {'f': False}),
+            ("let k = 1 in letfun f(n) = n + k in k := 2; f(1) end end", {'f': False}),
+            ("let k = 1 in letfun f(n) = n + k in f(1) end end", {'f': True}),
+            ("letfun f(g) = g(1) in f(f) end", {'f': False}),
+            ("letfun f(n) = show n in letfun g(n) = f(n) in g(1) end end", {'f': False, 'g': False}),
+            ("letfun f(n) = n in letfun g(n) = f(n) * 2 in g(1) end end", {'f': True, 'g': True}),
+            ("letfun f(n) = letfun g(m) = f(m) in (show n; g) end in f(1) end", {'f': False, 'g': False}),
+            ("letfun f(n) = letfun g(m) = m + n in g end in f(1)(2) end", {'f': True, 'g': True}),
+        ]:
+            with self.subTest(source=source):
+                self.assertEqual(self.pure_functions(source), expected)
+
+    def test_outer_names_are_impure(self):
+        self.assertEqual(self.pure_functions("letfun f(n) = n + k in f(1) end", ('k',)), {'f': False})
+
+    def test_memoized(self):
+        from parse_run import parse_ast
+        store = interp.Store()
+        self.assertEqual(interp.eval(parse_ast(self.FIB), None, store), 75025)
+        self.assertEqual((store.memo_misses, store.memo_hits), (26, 23))
+        self.assertLess(store.allocations, 100)
+
+    def test_disabled(self):
+        from parse_run import parse_ast
+        store = interp.Store(memo_size=0)
+        self.assertEqual(interp.eval(parse_ast(self.FIB), None, store), 75025)
+        self.assertEqual((store.memo_misses, store.memo_hits), (0, 0))
+        self.assertGreater(store.allocations, 200000)
+
+    def test_codegen(self):
+        import codegen
+        from parse_run import parse_ast
+        store = interp.Store()
+        self.assertEqual(interp.runCode(codegen.compile_ast(parse_ast(self.FIB)), interp.emptyEnv, store), 75025)
+        self.assertEqual(store.memo_hits, 23)
+
+    def test_effects_repeat(self):
+        from parse_run import parse_ast
+        out = StringIO()
+        with redirect_stdout(out):
+            result = interp.eval(parse_ast("letfun f(n) = (show n; n) in f(1) + f(1) end"))
+        self.assertEqual((result, out.getvalue()), (2, "1\n1\n"))
+        source = "let k = 1 in letfun f(n) = n + k in f(1) + (k := 10; f(1)) end end"
+        self.assertEqual(interp.eval(parse_ast(source)), 13)
+
+    def test_lru_eviction(self):
+        from parse_run import parse_ast
+        store = interp.Store(memo_size=2)
+        f = interp.eval(parse_ast("letfun f(n) = n * 2 in f(1); f(2); f(1); f(3); f end"), None, store)
+        self.assertEqual(list(f.memo), [1, 3])
+        self.assertEqual(dict(f.memo), {1: 2, 3: 6})
+        self.assertEqual(store.memo_hits, 1)
+
+    def test_keys(self):
+        self.assertNotEqual(interp.memoKey(True), interp.memoKey(1))
+        self.assertIsNone(interp.memoKey(interp.Closure('x', Lit(1), None)))
+        self.assertIsNone(interp.memoKey({'type': 'command'}))
+
+    def test_closures_are_not_remembered(self):
+        from parse_run import parse_ast
+        f = interp.eval(parse_ast("letfun f(n) = letfun g(m) = m + n in g end in f(1)(1) + f(1)(2); f end"))
+        self.assertEqual(len(f.memo), 0)
+
+
+class TestTypeInference(unittest.TestCase):
+    def infer(self, source, scope=()):
+        from parse_run import parse_ast
+        inference = interp.TypeInference()
+        return inference.infer(interp.resolve(parse_ast(source), scope)), inference
+
+    def operand_types(self, e):
+        found, stack = [], [e]
+        while stack:
+            node = stack.pop()
+            if getattr(node, 'types', None) is not None:
+                found.append((type(node).__name__, node.types))
+            stack.extend(reversed(interp.subexprs(node)))
+        return found
+
+    def test_fib(self):
+        _, inference = self.infer("letfun fib(n) = if n < 2 then n else fib(n - 1) + fib(n - 2) in fib(20) end")
+        self.assertEqual(inference.breakdown(), {'Add': (1, 1), 'If': (1, 1), 'Lt': (1, 1), 'Sub': (2, 2)})
+
+    def test_operand_types(self):
+        for source, expected in [
+            ('"a" + 1', [('Add', ('str', 'int'))]),
+            ('1 + "a"', [('Add', ('int', 'str'))]),
+            ('let s = "x" in s + s end', [('Add', ('str', 'str'))]),
+            ("!(1 < 2) && true", [('And', ('bool', 'bool')), ('Not', ('bool',)), ('Lt', ('int', 'int'))]),
+            ("-read", [('Neg', ('int',))]),
+            ("let x = 1 in x := 2; x * 3 end", [('Mul', ('int', 'int'))]),
+            ('let x = 1 in x := "a"; x * 3 end', [('Mul', ('any', 'int'))]),
+            ("let x = `ls` in x - 1 end", [('Sub', ('command', 'int'))]),
+            ("letfun f(n) = n + 1 in letfun g(h) = h(2) in g(f) end end", [('Add', ('any', 'int'))]),
+            ("letfun f(n) = n in f(1) - f(true) end", [('Sub', ('any', 'any'))]),
+            ("letfun f(n) = f(n) in f(1) > 0 end", [('Gt', ('any', 'int'))]),
+        ]:
+            with self.subTest(source=source):
+                self.assertEqual(self.operand_types(self.infer(source)[0]), expected)
+
+    def test_outer_names(self):
+        e, inference = self.infer("x + 1", ('x',))
+        self.assertEqual(self.operand_types(e), [('Add', ('any', 'int'))])
+        self.assertEqual(inference.breakdown(), {'Add': (1, 0)})
+
+    def test_unproven_checks_still_raise(self):
+        import codegen
+        from parse_run import parse_ast
+        for source in ['let x = 1 in x := "a"; x * 3 end', "letfun f(n) = n in f(1) - f(\"a\") end",
+                       "let x = 1 in if x then 1 else 2 end", "letfun f(n) = !n in f(true); f(1) end"]:
+            with self.subTest(source=source):
+                with self.assertRaises(TypeError):
+                    interp.eval(parse_ast(source))
+                with self.assertRaises(TypeError):
+                    interp.runCode(codegen.compile_ast(parse_ast(source)), interp.emptyEnv, interp.Store())
+
+    def test_proven_paths(self):
+        import codegen
+        from parse_run import parse_ast
+        for source, expected in [
+            ('let s = "n" in let k = 3 in s + k + (k + s) end end', "n33n"),
+            ("let a = 7 in let b = 2 in (a / b) * -b - (a > b && b < a || false) end end", -7),
+            ("let x = 0 in if !(x < 1) then x / x else x - 1 end", -1),
+        ]:
+            with self.subTest(source=source):
+                annotated = self.operand_types(interp.optimizeExpr(parse_ast(source)))
+                self.assertTrue(annotated)
+                self.assertTrue(all(t in ('int', 'bool', 'str') for _, types in annotated for t in types), annotated)
+                self.assertEqual(interp.eval(parse_ast(source)), expected)
+                code = codegen.compile_ast(parse_ast(source))
+                self.assertEqual(interp.runCode(code, interp.emptyEnv, interp.Store()), expected)
+        with self.assertRaises(ZeroDivisionError):
+            interp.eval(parse_ast("let x = 0 in x / x end"))
+
+
+class TestInlineCaches(unittest.TestCase):
+    def run_program(self, source):
+        from parse_run import parse_ast
+        # Without type inference, so the nodes keep their checks and caches
+        code = interp.compileExpr(interp.resolve(parse_ast(source)))
+        return interp.runCode(code, interp.emptyEnv, interp.Store(memo_size=0)), interp.inlineCaches(code)
+
+    def cache(self, caches, node):
+        found = [c for c in caches if c.node == node]
+        self.assertEqual(len(found), 1, node)
+        return found[0]
+
+    def test_monomorphic(self):
+        result, caches = self.run_program("letfun fib(n) = if n < 2 then n else fib(n - 1) + fib(n - 2) in fib(15) end")
+        self.assertEqual(result, 610)
+        self.assertEqual(sorted(c.stats()['node'] for c in caches), ['Add', 'App', 'App', 'App', 'Lt'])
+        self.assertEqual(sum(c.deopts for c in caches), 0)
+        self.assertEqual(self.cache(caches, Lt(Name('n'), Lit(2))).hits, 1972)
+        self.assertTrue(all(not c.megamorphic for c in caches))
+
+    def test_deopt(self):
+        result, caches = self.run_program('letfun f(x) = x + x in f(1); f("a"); f(2) end')
+        self.assertEqual(result, 4)
+        add = self.cache(caches, Add(Name('x'), Name('x')))
+        self.assertEqual((add.hits, add.deopts, add.left, add.right), (0, 2, int, int))
+
+    def test_callee_deopt(self):
+        result, caches = self.run_program(
+            "letfun apply(h) = h(1) in letfun a(x) = x in letfun b(x) = x + 1 in apply(a) + apply(b) + apply(b) end end end")
+        self.assertEqual(result, 5)
+        call = self.cache(caches, App(Name('h'), Lit(1)))
+        self.assertEqual((call.hits, call.deopts), (1, 1))
+
+    def test_megamorphic(self):
+        result, caches = self.run_program(
+            'letfun g(v) = v + v in letfun loop(n) = if n == 0 then 0 else (g(n); g("s"); loop(n - 1)) in loop(30) end end')
+        self.assertEqual(result, 0)
+        add = self.cache(caches, Add(Name('v'), Name('v')))
+        self.assertTrue(add.megamorphic)
+        self.assertEqual(add.deopts, interp.InlineCache.MAX_DEOPTS + 1)
+        self.assertIsNone(add.fast)
+
+    def test_errors_after_specialising(self):
+        for source, error in [("letfun f(x) = x + 1 in f(1); f(f) end", TypeError),
+                              ("letfun f(x) = x < 1 in f(1); f(\"a\") end", TypeError),
+                              ("letfun call(h) = h(1) in letfun a(x) = x in call(a); call(3) end end", interp.EvalError)]:
+            with self.subTest(source=source):
+                with self.assertRaises(error):
+                    self.run_program(source)
+
+    def test_eq(self):
+        result, caches = self.run_program('letfun f(x) = x == 1 in f(1) && !f(true) && !f("1") && f(1) && f(1) end')
+        self.assertIs(result, True)
+        eq = self.cache(caches, Eq(Name('x'), Lit(1)))
+        self.assertEqual((eq.hits, eq.deopts, eq.left), (1, 1, int))
+
+
+class TestVMEval(TestEval):
+    # Reruns the TestEval corpus on the bytecode VM, collecting on every
+    # allocation, which must agree with interp_fun.eval.
+    def eval_with(self, expr, inputs):
+        import vm_eval
+        with redirect_stdin(StringIO("\n".join(inputs) + "\n")):
+            return vm_eval.eval(expr, None, interp.Store(gc_threshold=1))
+
+
+class TestVM(unittest.TestCase):
+    PROGRAMS = [
+        "letfun fib(n) = if n < 2 then n else fib(n - 1) + fib(n - 2) in fib(15) end",
+        "let s = 0 in letfun loop(n) = if n == 0 then s else (s := s + n; loop(n - 1)) in loop(500) end end",
+        'let s = "id-" in s + 42 + (7 - 2 * 3) + -4 end',
+        "let x = read in let y = read in show x; show y; if x < y && !(x == y) || false then y / x else x end end",
+        "letfun adder(x) = letfun add(y) = x + y in add end in let a = adder(10) in a(1) + adder(20)(2) end end",
+        Let("n", Lit(3), interp.Ifnz(Sub(Name("n"), Lit(3)), Lit(1), Seq(Assign("n", Lit(10)), Name("n")))),
+        "letfun f(n) = if n == 0 then 0 else (let t = n * 2 in t + f(n - 1) end) in f(40) end",
+        "let x = 3 in `echo $x` && `true` || `false` end",
+        "let x = 3 in `ls -l $x` | `wc -l` end",
+        interp.Block([Show(Lit(1)), Show(Lit(True)), Show(interp.StrLit("s"))]),
+        "letfun f(n) = 1 + n in f(1) < f(2) && f(2) > f(1) end",
+    ]
+
+    def outcome(self, evaluate, e, inputs="6\n9\n"):
+        out = StringIO()
+        with redirect_stdout(out), redirect_stdin(StringIO(inputs)):
+            try:
+                result = evaluate(e)
+            except Exception as error:
+                result = (type(error), str(error))
+        return result, out.getvalue()
+
+    def test_agrees_with_eval(self):
+        import vm_eval
+        from parse_run import parse_ast
+        for source in self.PROGRAMS:
+            with self.subTest(source=source):
+                e = parse_ast(source) if isinstance(source, str) else source
+                self.assertEqual(self.outcome(vm_eval.eval, e), self.outcome(interp.eval, e))
+
+    def test_errors_agree_with_eval(self):
+        import vm_eval
+        from parse_run import parse_ast
+        for source in ["1 + true < 2", "if 1 then 2 else 3", "true && 1", "false || 2", "!3", "-true",
+                       "let x = 1 in x(2) end", "letfun f(n) = n in f := 1 end", "1 / 0", "show 1; 1 - \"a\"", "read",
+                       interp.Ifnz(Lit(True), Lit(1), Lit(2)), interp.ShellAnd(interp.Command("a"), Lit(1)),
+                       interp.ShellOr(Lit(1), interp.Command("a")), interp.Pipe(interp.Command("a"), Lit(1))]:
+            with self.subTest(source=source):
+                e = parse_ast(source) if isinstance(source, str) else source
+                self.assertEqual(self.outcome(vm_eval.eval, e, "x\n"), self.outcome(interp.eval, e, "x\n"))
+
+    def test_redirect(self):
+        import vm_eval
+        e = interp.Redirect(interp.Command("a $x"), "stdout", interp.Command("b"))
+        env, store = interp.extendEnv("x", 0, interp.emptyEnv), interp.Store()
+        store.alloc(5)
+        self.assertEqual(vm_eval.evalInEnv(env, store, e), interp.evalInEnv(env, store, e))
+        with self.assertRaises(ValueError):
+            vm_eval.eval(interp.Redirect(interp.Command("a"), "stdlog", interp.Command("b")))
+
+    def test_deep_recursion_and_tail_calls(self):
+        import vm_eval
+        from parse_run import parse_ast
+        self.assertEqual(vm_eval.eval(parse_ast("letfun f(n) = if n == 0 then 0 else 1 + f(n - 1) in f(50000) end")), 50000)
+        store = interp.Store(memo_size=0)
+        e = parse_ast("let s = 0 in letfun loop(n) = if n == 0 then s else (let t = n in s := s + t; loop(n - 1) end) "
+                      "in loop(100000) end end")
+        self.assertEqual(vm_eval.eval(e, None, store), 5000050000)
+        self.assertLessEqual(store.stats()['size'], 1024)
+        self.assertEqual(store.roots, [])
+
+    def test_closures_interoperate(self):
+        import vm_eval
+        from parse_run import parse_ast
+        store = interp.Store()
+        adder = vm_eval.eval(parse_ast("letfun adder(x) = letfun add(y) = x + y in add end in adder(10) end"), None, store)
+        env = interp.extendEnv("add", store.alloc(adder), interp.emptyEnv)
+        self.assertEqual(interp.evalInEnv(env, store, parse_ast("add(5) + add(6)")), 31)
+        inc = interp.eval(parse_ast("letfun inc(n) = n + 1 in inc end"), None, store)
+        env = interp.extendEnv("inc", store.alloc(inc), interp.emptyEnv)
+        self.assertEqual(vm_eval.evalInEnv(env, store, parse_ast("inc(inc(1))")), 3)
+
+    def test_memoized(self):
+        import vm_eval
+        from parse_run import parse_ast
+        store = interp.Store()
+        e = parse_ast("letfun fib(n) = if n < 2 then n else fib(n - 1) + fib(n - 2) in fib(25) end")
+        self.assertEqual(vm_eval.eval(e, None, store), 75025)
+        self.assertEqual(store.memo_hits, 23)
+
+    def test_disassemble(self):
+        import vm_eval
+        from parse_run import parse_ast
+        e = parse_ast("letfun f(n) = if n < 2 then n else f(n - 1) in f(5) end")
+        listing = vm_eval.disassemble(vm_eval.compile_expr(e, fusions=None))
+        self.assertEqual(listing.splitlines(), [
+            "<main>:",
+            "     0  MAKE_CLOSURE  0 (<function f(n)>)",
+            "     2  LOAD          0",
+            "     4  PUSH_ROOT",
+            "     6  CONST         1 (5)",
+            "     8  CALL",
+            "    10  UNBIND",
+            "    12  RETURN",
+            "f:",
+            "     0  LOAD          0",
+            "     2  CONST         0 (2)",
+            "     4  LT",
+            "     6  BRANCH_FALSE  -> 12",
+            "     8  LOAD          0",
+            "    10  JUMP          -> 24",
+            "    12  LOAD          1",
+            "    14  PUSH_ROOT",
+            "    16  LOAD          0",
+            "    18  CONST         1 (1)",
+            "    20  SUB",
+            "    22  TAIL_CALL",
+            "    24  RETURN",
+        ])
+
+
+class TestSuperinstructions(unittest.TestCase):
+    def listing(self, source, fusions=None):
+        import vm_eval
+        from parse_run import parse_ast
+        e = parse_ast(source) if isinstance(source, str) else source
+        kwargs = {} if fusions is None else {'fusions': fusions}
+        return vm_eval.disassemble(vm_eval.compile_expr(e, **kwargs)).splitlines()
+
+    def test_fused_listing(self):
+        self.assertEqual(self.listing("letfun f(n) = if n < 2 then n else f(n - 1) in f(5) end"), [
+            "<main>:",
+            "     0  MAKE_CLOSURE  0 (<function f(n)>)",
+            "     2  LOAD_CALLEE   0",
+            "     4  CONST         1 (5)",
+            "     6  CALL",
+            "     8  RETURN",
+            "f:",
+            "     0  LOAD_OP_CONST 2 (0 LT 2)",
+            "     2  BRANCH_FALSE  -> 8",
+            "     4  LOAD          0",
+            "     6  RETURN",
+            "     8  LOAD_CALLEE   1",
+            "    10  LOAD_OP_CONST 3 (0 SUB 1)",
+            "    12  TAIL_CALL",
+            "    14  RETURN",
+        ])
+
+    def test_each_superinstruction(self):
+        cases = {
+            'BINARY_CONST': ("let x = read in (x * x) + 1 end", "BINARY_CONST"),
+            'COMPARE_BRANCH': ("let x = read in if x * x < x + x then 1 else 2 end", "BRANCH_NOT_LT"),
+            'LOAD_CALLEE': ("letfun f(n) = n in f(read) end", "LOAD_CALLEE"),
+        }
+        for name, (source, op) in cases.items():
+            with self.subTest(name=name):
+                self.assertTrue(any(op in line for line in self.listing(source, frozenset({name}))))
+                self.assertFalse(any(op in line for line in self.listing(source, frozenset())))
+
+    def test_peephole_cleanups(self):
+        # Nested ifs: the inner JUMP to the outer one is threaded past it
+        listing = self.listing("let a = read in (if a < 1 then if a < 0 then 1 else 2 else 3) + a end", frozenset())
+        jumps = [line for line in listing if "JUMP" in line]
+        self.assertEqual(len({line.split("->")[1] for line in jumps}), 1)
+        # An assignment's stored value is reused rather than popped and reloaded
+        listing = self.listing("let s = read in s := s + 1; s end", frozenset())
+        self.assertNotIn("POP", " ".join(listing))
+        # A scope exit before RETURN is dropped
+        self.assertNotIn("UNBIND", " ".join(self.listing("let s = read in s end", frozenset())))
+
+    def test_fusions_agree_with_eval(self):
+        import vm_eval
+        from functools import partial
+        from parse_run import parse_ast
+        sources = TestVM.PROGRAMS + ["let x = read in if x < 1 then 1 else if x > 7 then x else -x end",
+                                     "letfun f(n) = n < 1 in f(0) == true && f(2) == false end",
+                                     "let x = read in x := x + 1; x := x * 2; x end"]
+        for fusions in [frozenset(), *({name} for name in vm_eval.SUPERINSTRUCTIONS), vm_eval.ALL_SUPERINSTRUCTIONS]:
+            for source in sources:
+                with self.subTest(fusions=sorted(fusions), source=source):
+                    e = parse_ast(source) if isinstance(source, str) else source
+
+                    def run(e, fusions=frozenset(fusions)):
+                        store = interp.Store(gc_threshold=1)
+                        store.roots.append(interp.emptyEnv)
+                        return vm_eval.run_chunk(vm_eval.compile_expr(e, fusions=fusions), interp.emptyEnv, store)
+                    self.assertEqual(TestVM.outcome(self, run, e), TestVM.outcome(self, interp.eval, e))
+
+    def test_profile_selects_and_dispatches_drop(self):
+        import vm_eval
+        from collections import Counter
+        from parse_run import parse_ast
+        e = parse_ast("letfun fib(n) = if n < 2 then n else fib(n - 1) + fib(n - 2) in fib(12) end")
+        dispatches = {}
+        for fusions in (None, vm_eval.ALL_SUPERINSTRUCTIONS):
+            profile, store = Counter(), interp.Store(memo_size=0)
+            store.roots.append(interp.emptyEnv)
+            self.assertEqual(vm_eval.run_chunk(vm_eval.compile_expr(e, fusions=fusions), interp.emptyEnv, store, profile), 144)
+            self.assertEqual(store.roots, [interp.emptyEnv])
+            dispatches[fusions] = (profile, sum(profile.values()))
+        raw, fused = dispatches[None], dispatches[vm_eval.ALL_SUPERINSTRUCTIONS]
+        self.assertLess(fused[1], raw[1] * 0.6)
+        self.assertEqual(vm_eval.select_superinstructions(raw[0]), vm_eval.ALL_SUPERINSTRUCTIONS)
+        profile = Counter({(vm_eval.LOAD, vm_eval.PUSH_ROOT): 60, (vm_eval.LT, vm_eval.BRANCH_FALSE): 39,
+                           (vm_eval.CONST, vm_eval.ADD): 1})
+        self.assertEqual(vm_eval.select_superinstructions(profile, 0.05), {'LOAD_CALLEE', 'COMPARE_BRANCH'})
+
+
+class TestTieredEval(TestEval):
+    # Reruns the TestEval corpus on the VM with tiered execution, promoting
+    # after two calls and nesting at most three compiled calls
+    def eval_with(self, expr, inputs):
+        import vm_eval
+        with redirect_stdin(StringIO("\n".join(inputs) + "\n")):
+            return vm_eval.eval(expr, None, interp.Store(gc_threshold=1), vm_eval.Tiers(threshold=2, max_nesting=3))
+
+
+class TestTiers(unittest.TestCase):
+    FIB = "letfun fib(n) = if n < 2 then n else fib(n - 1) + fib(n - 2) in fib(15) end"
+
+    def test_agrees_with_eval(self):
+        import vm_eval
+        from parse_run import parse_ast
+        for threshold in (1, 3, 1000):
+            for source in TestVM.PROGRAMS:
+                with self.subTest(threshold=threshold, source=source):
+                    e = parse_ast(source) if isinstance(source, str) else source
+                    tiered = lambda e: vm_eval.eval(e, None, None, vm_eval.Tiers(threshold=threshold))
+                    self.assertEqual(TestVM.outcome(self, tiered, e), TestVM.outcome(self, interp.eval, e))
+
+    def test_promotion(self):
+        import vm_eval
+        from parse_run import parse_ast
+        tiers = vm_eval.Tiers(threshold=20)
+        chunk = vm_eval.compile_expr(parse_ast(self.FIB), tiers=tiers)
+        store = interp.Store(memo_size=0)
+        store.roots.append(interp.emptyEnv)
+        self.assertEqual(vm_eval.run_chunk(chunk, interp.emptyEnv, store), 610)
+        fib = chunk.consts[0]
+        self.assertEqual(tiers.log, [('promote', 'fib', 20)])
+        self.assertIsNotNone(fib.compiled)
+        self.assertEqual(fib.calls + 20, 1973)  # fib(15) makes 1973 calls in all
+        self.assertEqual(tiers.stats()['promotions'], 1)
+        self.assertEqual(store.roots, [interp.emptyEnv])
+
+    def test_cold_code_stays_on_vm(self):
+        import vm_eval
+        from parse_run import parse_ast
+        tiers = vm_eval.Tiers(threshold=50)
+        self.assertEqual(vm_eval.eval(parse_ast("letfun f(n) = n + 1 in f(1) + f(2) end"), None, None, tiers), 5)
+        self.assertEqual(tiers.log, [])
+
+    def test_loops_count(self):
+        import vm_eval
+        from parse_run import parse_ast
+        tiers = vm_eval.Tiers(threshold=10)
+        chunk = vm_eval.compile_expr(parse_ast("letfun loop(n) = if n == 0 then 0 else loop(n - 1) in loop(5) end"), tiers=tiers)
+        store = interp.Store()
+        store.roots.append(interp.emptyEnv)
+        vm_eval.run_chunk(chunk, interp.emptyEnv, store)
+        self.assertEqual((chunk.consts[0].calls, chunk.consts[0].loops), (1, 5))
+        self.assertEqual(tiers.log, [])
+
+    def test_demotion(self):
+        import vm_eval
+        from parse_run import parse_ast
+        tiers = vm_eval.Tiers(threshold=5, max_compiled=1)
+        e = parse_ast("letfun f(n) = if n == 0 then 0 else 1 + f(n - 1) in "
+                      "letfun g(n) = if n == 0 then 0 else 2 + g(n - 1) in f(10) + g(10) + f(10) end end")
+        self.assertEqual(vm_eval.eval(e, None, interp.Store(memo_size=0), tiers), 40)
+        self.assertEqual([(event, name) for event, name, _ in tiers.log],
+                         [('promote', 'f'), ('demote', 'f'), ('promote', 'g'), ('demote', 'g'), ('promote', 'f')])
+        self.assertEqual(tiers.stats()['compiled'], 1)
+
+    def test_deep_recursion(self):
+        import vm_eval
+        from parse_run import parse_ast
+        tiers = vm_eval.Tiers(threshold=1)
+        e = parse_ast("letfun f(n) = if n == 0 then 0 else 1 + f(n - 1) in f(50000) end")
+        self.assertEqual(vm_eval.eval(e, None, None, tiers), 50000)
+        self.assertEqual(tiers.nesting, 0)
+        e = parse_ast("let s = 0 in letfun loop(n) = if n == 0 then s else (s := s + n; loop(n - 1)) in loop(100000) end end")
+        self.assertEqual(vm_eval.eval(e, None, None, vm_eval.Tiers(threshold=1)), 5000050000)
+
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+@unittest.skipIf(numpy is None, "batch_eval needs numpy")
+class TestBatchEval(unittest.TestCase):
+    COLUMNS = {'x': [3, 0, -1, 5, -7, 2 ** 62, -(2 ** 63), 1], 'y': [10, -7, 4, 0, 9, 3, -1, 1],
+               'b': [True, False, True, False, True, True, False, False]}
+
+    def scalar(self, e, columns, row):
+        env, store = interp.emptyEnv, interp.Store()
+        for name, column in columns.items():
+            value = column[row].item() if isinstance(column[row], numpy.generic) else column[row]
+            env = interp.extendEnv(name, store.alloc(value), env)
+        try:
+            return interp.evalInEnv(env, store, e)
+        except Exception as error:
+            return (type(error), str(error))
+
+    def check(self, source, columns=None, vectorized=True):
+        import batch_eval
+        from parse_run import parse_ast
+        columns = self.COLUMNS if columns is None else columns
+        e = parse_ast(source) if isinstance(source, str) else source
+        result = batch_eval.eval_batch(e, columns)
+        for row in range(len(result)):
+            try:
+                outcome = result.outcome(row)
+            except Exception as error:
+                outcome = (type(error), str(error))
+            expected = self.scalar(e, columns, row)
+            self.assertEqual((outcome, type(outcome)), (expected, type(expected)), f"row {row}")
+        if vectorized:
+            self.assertLess(result.scalar_rows, len(result))
+        return result
+
+    def test_agrees_with_eval(self):
+        for source in ["x + y * 2 - -x", "x / y", "y / x", "(x + 1) / (y - 1)", "x < y", "x > y", "x == y", "b == true",
+                       "b == 1", "x == b", "b + b", "-b", "b && x < y", "b || x / y == 0", "!b && (y / x > 1)",
+                       "if b then x / y else y / x", "if x < 0 then -x else x", "if b then b else x > 0",
+                       "if y == 0 then 0 else x / y", "x * x * x", "x + x", "x - y - y", "!(x < 1) || b",
+                       "x && b", "b && x", "!x", "if x then 1 else 2", "7 / 2 + -7 / 2", "y / 0 + x / 0"]:
+            with self.subTest(source=source):
+                self.check(source)
+
+    def test_division_by_zero_per_row(self):
+        result = self.check("x / y", {'x': [7, -7, 1, 4], 'y': [2, 2, 0, -3]})
+        self.assertEqual(list(result.errors), [2])
+        self.assertIsInstance(result.errors[2], ZeroDivisionError)
+        self.assertEqual([result.values[i] for i in (0, 1, 3)], [3, -4, -2])
+        self.assertEqual(result.scalar_rows, 0)
+
+    def test_overflow_reruns_rows(self):
+        result = self.check("x * x + y", {'x': [2 ** 40, 3], 'y': [1, 1]})
+        self.assertEqual((result.outcome(0), result.scalar_rows), (2 ** 80 + 1, 1))
+
+    def test_numpy_columns(self):
+        self.check("x / y + 1", {'x': numpy.array([5, 9, -3]), 'y': numpy.array([2, 0, 2], dtype=numpy.uint8)})
+        self.check("b || x > 1", {'x': numpy.arange(4), 'b': numpy.array([True, False, False, True])})
+
+    def test_scalar_fallback(self):
+        for source, columns in [("let z = x in z * 2 end", None), ("q + 1", None), ('x + "s"', None),
+                                ("if b then 1 else false", None), ("x + 1", {'x': [1, True, 2 ** 70]}),
+                                ("x + 1", {'x': ["a", "b"]}), ("show x", {'x': [1]})]:
+            with self.subTest(source=source):
+                with redirect_stdout(StringIO()):
+                    result = self.check(source, columns, vectorized=False)
+                self.assertEqual(result.scalar_rows, len(result))
+
+    def test_columns_must_match(self):
+        import batch_eval
+        with self.assertRaises(ValueError):
+            batch_eval.eval_batch(Add(Name("x"), Name("y")), {'x': [1, 2], 'y': [1]})
+
+
 if __name__ == "__main__":
     unittest.main()
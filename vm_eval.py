@@ -0,0 +1,760 @@
+'''Stack-based bytecode VM for interp_fun ASTs.
+
+compile_expr() flattens an optimized, resolved AST into a Chunk: one array of
+(opcode, operand) pairs plus a constant pool.  Every letfun body becomes a
+Function in the pool with a chunk of its own.  run_chunk() executes a chunk
+with a single dispatch loop over that array, an operand stack and a stack of
+call frames, so neither evaluation nor calls recurse in Python.
+
+Values, environments and the Store are the ones interp_fun uses: results,
+errors, Show/Read output, location aliasing, store collection (see
+interp_fun.Store), tail calls and memoization of pure functions all behave as
+in interp_fun.eval.  disassemble() lists a chunk's instructions.
+
+With a Tiers, letfun bodies start out on the VM and move to code compiled by
+codegen once they are called often, so code that runs once costs only the
+cheap bytecode compile.
+'''
+
+import operator
+import time
+from array import array
+from collections import Counter
+
+import codegen
+
+from interp_fun import (Closure, Code, EvalError, Expr, Store, TailCall, addValues, divValues, emptyEnv, envLoc, envNames,
+                        extendEnv, lookupEnv, memoKey, memoRecall, memoRemember, newMemo, optimizeExpr, resolve,
+                        seqSpine)
+from interp_fun import Add, Sub, Mul, Div, Neg, Let, Name, Lit, Command, And, Or, Not, Eq, Lt, Gt, If, Pipe, Redirect, Ifnz, Letfun, App, Assign, Seq, Block, Show, Read, ShellAnd, ShellOr, StrLit
+
+
+# Opcodes.  Every instruction is two array slots, the opcode and its operand
+# (0 where it has none); the comments say what the operand is.
+OPCODES = (
+    'CONST',         # constant pool index: push the constant
+    'LOAD',          # depth: push the value of the variable that many frames out
+    'CHECK_ASSIGN',  # pool index of (name, depth): fail before the value runs if the target is a function
+    'STORE',         # pool index of (name, depth): store the top of the stack, leaving it there
+    'POP',           # discard the top of the stack
+    'ADD', 'SUB', 'MUL', 'DIV', 'LT', 'GT', 'EQ', 'PIPE',  # binary operators on the top two values
+    'NEG', 'NOT',
+    'AND',           # target: check a boolean; if false leave it and jump, else pop it
+    'OR',            # target: check a boolean; if true leave it and jump, else pop it
+    'CHECK_BOOL',    # 0 for And, 1 for Or: check the right operand is a boolean
+    'BRANCH_FALSE',  # target: pop an If condition, jump if it is false
+    'BRANCH_ZERO',   # target: pop an Ifnz condition, jump if it is zero
+    'JUMP',          # target
+    'BIND',          # pool index of the name: bind the popped value in a new scope
+    'UNBIND',        # leave the innermost scope
+    'MAKE_CLOSURE',  # pool index of a Function: bind a new closure in a new scope
+    'PUSH_ROOT',     # keep the callee on the stack alive while its argument runs
+    'CALL',          # call the callee below the argument with it
+    'TAIL_CALL',     # the same, replacing the current call frame
+    'RETURN',        # return the top of the stack from the current call (or the chunk)
+    'SHOW', 'READ',
+    'COMMAND',       # pool index of the command's parts
+    'CHECK_STREAM',  # pool index of (stream, target): reject an invalid stream before the command runs
+    'REDIRECT',      # pool index of (stream, target)
+    'SHELL_LEFT',    # 0 for &&, 1 for ||: check the left operand is a command
+    'SHELL_RIGHT',   # the same for the right operand, and build the combined command
+    # Superinstructions, produced only by the peephole pass (see _Compiler.optimize)
+    'LOAD_OP_CONST', # pool index of (depth, binary opcode, value): LOAD; CONST; binary operator
+    'BINARY_CONST',  # pool index of (binary opcode, value): CONST; binary operator
+    'BRANCH_NOT_LT', 'BRANCH_NOT_GT', 'BRANCH_NOT_EQ',  # target: LT/GT/EQ; BRANCH_FALSE
+    'LOAD_CALLEE',   # depth: LOAD; PUSH_ROOT
+)
+for _i, _name in enumerate(OPCODES):
+    globals()[_name] = _i
+
+_BINARY = {Add: ADD, Sub: SUB, Mul: MUL, Div: DIV, Lt: LT, Gt: GT, Eq: EQ, Pipe: PIPE}
+_JUMPS = {AND, OR, BRANCH_FALSE, BRANCH_ZERO, JUMP, BRANCH_NOT_LT, BRANCH_NOT_GT, BRANCH_NOT_EQ}
+_COMPARE_BRANCH = {LT: BRANCH_NOT_LT, GT: BRANCH_NOT_GT, EQ: BRANCH_NOT_EQ}
+
+# The superinstructions the peephole pass may use, with the instruction sequences
+# each replaces.  select_superinstructions() picks those a profile says are worth it.
+SUPERINSTRUCTIONS = {
+    'LOAD_OP_CONST': ((LOAD, CONST, ADD), (LOAD, CONST, SUB), (LOAD, CONST, MUL), (LOAD, CONST, DIV),
+                      (LOAD, CONST, LT), (LOAD, CONST, GT), (LOAD, CONST, EQ)),
+    'BINARY_CONST': ((CONST, ADD), (CONST, SUB), (CONST, MUL), (CONST, DIV), (CONST, LT), (CONST, GT), (CONST, EQ)),
+    'COMPARE_BRANCH': ((LT, BRANCH_FALSE), (GT, BRANCH_FALSE), (EQ, BRANCH_FALSE)),
+    'LOAD_CALLEE': ((LOAD, PUSH_ROOT),),
+}
+ALL_SUPERINSTRUCTIONS = frozenset(SUPERINSTRUCTIONS)
+
+
+class Chunk:
+    '''Compiled code: code holds opcode, operand pairs; consts the values operands index'''
+    __slots__ = ('code', 'consts', 'name')
+
+    def __init__(self, code: array, consts: list, name: str):
+        self.code = code
+        self.consts = consts
+        self.name = name
+
+
+class Function:
+    '''The compiled body of a letfun.  Calling it runs the body on the VM, so it can
+    also serve as the Closure's code for interp_fun's compiled App.
+
+    calls and loops count the calls and the tail calls (loop iterations) that
+    entered the body.  With tiers, a body entered often enough moves to code
+    compiled by codegen (see Tiers), and compiled then holds that code.'''
+    __slots__ = ('name', 'param', 'body', 'chunk', 'pure', 'tiers', 'calls', 'loops', 'compiled')
+
+    def __init__(self, name: str, param: str, body: Expr, chunk: Chunk, pure: bool, tiers: 'Tiers | None' = None):
+        self.name = name
+        self.param = param
+        self.body = body
+        self.chunk = chunk
+        self.pure = pure
+        self.tiers = tiers
+        self.calls = 0
+        self.loops = 0
+        self.compiled: Code | None = None
+
+    def __call__(self, env, store):
+        self.calls += 1
+        tiers = self.tiers
+        if tiers is not None and tiers.nesting < tiers.max_nesting:
+            code = self.compiled
+            if code is None and self.calls + self.loops >= tiers.threshold:
+                code = tiers.promote(self, env)
+            if code is not None:
+                # As Tiers.run, inlined: this is how compiled code calls compiled code
+                tiers.nesting += 1
+                try:
+                    return code(env, store)  # The caller runs a TailCall this returns
+                finally:
+                    tiers.nesting -= 1
+        return run_chunk(self.chunk, env, store)
+
+    def __repr__(self) -> str:
+        return f'<function {self.name}({self.param})>'
+
+
+class Tiers:
+    '''Tiered execution: Functions run on the VM until they are hot, then as code
+    compiled by codegen.
+
+    A Function is promoted once its calls plus loops reach threshold; its
+    counters then restart, counting entries to the compiled code.  At most
+    max_compiled bodies stay compiled: promoting another one first demotes the
+    compiled body entered least often since its promotion, which goes back to
+    the VM and to counting towards promotion.  log records every move as
+    (event, function name, calls + loops at the time), and stats() sums them up.
+
+    Compiled code recurses on the Python stack, which the VM does not, so once
+    max_nesting compiled calls are running inside each other, further calls
+    stay on the VM until they return.'''
+    def __init__(self, threshold: int = 50, max_compiled: int = 64, max_nesting: int = 100):
+        self.threshold = threshold
+        self.max_compiled = max_compiled
+        self.max_nesting = max_nesting
+        self.nesting = 0
+        self.compiled: dict[Function, None] = {}  # Ordered by promotion
+        self.log: list[tuple[str, str, int]] = []
+        self.compile_seconds = 0.0
+
+    def promote(self, function: Function, env) -> Code:
+        '''Compile function's body for env (the environment of a call) and run it from now on'''
+        if len(self.compiled) >= self.max_compiled:
+            self.demote(min(self.compiled, key=lambda f: f.calls + f.loops))
+        start = time.perf_counter()
+        # The body is a part of the optimized program: compile it as it is, keeping its inferred types
+        code = codegen.compile_ast(function.body, f'<fun {function.name}>', envNames(env), tail=True, optimized=True)
+        self.compile_seconds += time.perf_counter() - start
+        self.log.append(('promote', function.name, function.calls + function.loops))
+        function.compiled, function.calls, function.loops = code, 0, 0
+        self.compiled[function] = None
+        return code
+
+    def run(self, function: Function, env, store: Store):
+        '''Run function's compiled code for a call, promoting it first if need be'''
+        code = function.compiled or self.promote(function, env)
+        self.nesting += 1
+        try:
+            return code(env, store)
+        finally:
+            self.nesting -= 1
+
+    def demote(self, function: Function) -> None:
+        '''Send function back to the VM'''
+        self.log.append(('demote', function.name, function.calls + function.loops))
+        function.compiled, function.calls, function.loops = None, 0, 0
+        del self.compiled[function]
+
+    def stats(self) -> dict[str, int | float]:
+        events = [event for event, _, _ in self.log]
+        return {'promotions': events.count('promote'), 'demotions': events.count('demote'),
+                'compiled': len(self.compiled), 'compile_ms': self.compile_seconds * 1000}
+
+
+# -- Compiler -- #
+
+class _Compiler:
+    def __init__(self, name: str, fusions: frozenset[str] | None, tiers: Tiers | None):
+        self.name = name
+        self.fusions = fusions
+        self.tiers = tiers
+        self.code = array('i')
+        self.consts: list = []
+        self._const_index: dict = {}
+
+    def const(self, value) -> int:
+        # Keyed by type as well, so 1 and True (or (0, 1) and (0, True)) get separate entries
+        if isinstance(value, tuple):
+            key = (tuple, value, tuple(map(type, value)))
+        else:
+            key = (type(value), value) if isinstance(value, (int, str)) else (type(value), id(value))
+        index = self._const_index.get(key)
+        if index is None:
+            index = self._const_index[key] = len(self.consts)
+            self.consts.append(value)
+        return index
+
+    def emit(self, op: int, arg: int = 0) -> int:
+        '''Append an instruction and return its offset'''
+        self.code.append(op)
+        self.code.append(arg)
+        return len(self.code) - 2
+
+    def patch(self, offset: int) -> None:
+        '''Point the jump at offset to the next instruction'''
+        self.code[offset + 1] = len(self.code)
+
+    def chunk(self) -> Chunk:
+        if self.fusions is not None:
+            self.optimize()
+        return Chunk(self.code, self.consts, self.name)
+
+    def optimize(self) -> None:
+        '''Peephole pass over the finished code: thread jumps, drop jumps to the next
+        instruction, dead code, values pushed only to be popped, reloads of a just
+        stored variable and scope exits right before a RETURN, then fuse the
+        sequences of the superinstructions in self.fusions.  Repeats until nothing changes.'''
+        code = self.code
+        ins = [[code[i], code[i + 1] // 2 if code[i] in _JUMPS else code[i + 1]] for i in range(0, len(code), 2)]
+        while True:
+            before = len(ins)
+            ins = self._compact(self._reachable(self._cleanup(ins)))
+            ins = self._compact(self._fuse(ins))
+            if len(ins) == before:
+                break
+        self.code = array('i')
+        for op, arg in ins:
+            self.emit(op, arg * 2 if op in _JUMPS else arg)
+
+    def _cleanup(self, ins: list) -> list:
+        targets = {arg for op, arg in ins if op in _JUMPS}
+        for i, (op, arg) in enumerate(ins):
+            if op in _JUMPS:
+                seen = set()
+                while ins[arg][0] == JUMP and arg not in seen:
+                    seen.add(arg)
+                    arg = ins[arg][1]
+                ins[i][1] = arg
+                if op == JUMP and ins[arg][0] == RETURN:
+                    ins[i] = [RETURN, 0]
+
+        def following(i, n=1):
+            # The instruction n after i, if control can only reach it from i
+            j = i + n
+            if j < len(ins) and all(k not in targets for k in range(i + 1, j + 1)):
+                return tuple(ins[j] or (None, None))
+            return None, None
+
+        for i, instruction in enumerate(ins):
+            if instruction is None:
+                continue
+            op, arg = instruction
+            if op == JUMP and arg == i + 1:
+                ins[i] = None
+            elif op in (LOAD, CONST) and following(i)[0] == POP:
+                ins[i] = ins[i + 1] = None
+            elif op == UNBIND and i + 1 < len(ins) and ins[i + 1] is not None and ins[i + 1][0] == RETURN:
+                ins[i] = None  # RETURN drops the call's scopes anyway
+            elif op == STORE and following(i)[0] == POP and following(i, 2) == (LOAD, self.consts[arg][1]):
+                ins[i + 1] = ins[i + 2] = None  # STORE leaves the stored value on the stack already
+        return ins
+
+    @staticmethod
+    def _reachable(ins: list) -> list:
+        live, pending = [False] * len(ins), [0]
+        while pending:
+            i = pending.pop()
+            while i < len(ins) and ins[i] is None:
+                i += 1
+            if i >= len(ins) or live[i]:
+                continue
+            live[i] = True
+            op, arg = ins[i]
+            if op in _JUMPS:
+                pending.append(arg)
+            if op != JUMP and op != RETURN:
+                pending.append(i + 1)
+        return [instruction if alive else None for instruction, alive in zip(ins, live)]
+
+    def _fuse(self, ins: list) -> list:
+        fusions = self.fusions
+        targets = {arg for op, arg in ins if op in _JUMPS}
+        i = 0
+        while i < len(ins):
+            op, arg = ins[i]
+            # Only fuse a sequence that nothing jumps into the middle of
+            nxt = ins[i + 1] if i + 1 < len(ins) and i + 1 not in targets else (None, None)
+            third = ins[i + 2] if nxt[0] is not None and i + 2 < len(ins) and i + 2 not in targets else (None, None)
+            if ('LOAD_OP_CONST' in fusions and op == LOAD and nxt[0] == CONST
+                    and (LOAD, CONST, third[0]) in SUPERINSTRUCTIONS['LOAD_OP_CONST']):
+                ins[i] = [LOAD_OP_CONST, self.const((arg, third[0], self.consts[nxt[1]]))]
+                ins[i + 1] = ins[i + 2] = None
+                i += 3
+                continue
+            if 'BINARY_CONST' in fusions and op == CONST and (CONST, nxt[0]) in SUPERINSTRUCTIONS['BINARY_CONST']:
+                ins[i] = [BINARY_CONST, self.const((nxt[0], self.consts[arg]))]
+                ins[i + 1] = None
+            elif 'COMPARE_BRANCH' in fusions and op in _COMPARE_BRANCH and nxt[0] == BRANCH_FALSE:
+                ins[i] = [_COMPARE_BRANCH[op], nxt[1]]
+                ins[i + 1] = None
+            elif 'LOAD_CALLEE' in fusions and op == LOAD and nxt[0] == PUSH_ROOT:
+                ins[i] = [LOAD_CALLEE, arg]
+                ins[i + 1] = None
+            else:
+                i += 1
+                continue
+            i += 2
+        return ins
+
+    @staticmethod
+    def _compact(ins: list) -> list:
+        '''Drop the deleted (None) instructions, retargeting jumps to the next one kept'''
+        index, kept = [], []
+        for instruction in ins:
+            index.append(len(kept))
+            if instruction is not None:
+                kept.append(instruction)
+        for instruction in kept:
+            if instruction[0] in _JUMPS:
+                instruction[1] = index[instruction[1]]
+        return kept
+
+    def expr(self, e: Expr, tail: bool = False) -> None:
+        '''Emit code leaving e's value on the stack.  With tail=True, e is in tail
+        position of a function body, and a call there replaces the current frame.'''
+        match e:
+            case Lit(value) | StrLit(value):
+                self.emit(CONST, self.const(value))
+            case Name(name):
+                self.emit(LOAD, e.depth)
+            case Add(left, right) | Sub(left, right) | Mul(left, right) | Div(left, right) \
+                    | Lt(left, right) | Gt(left, right) | Eq(left, right) | Pipe(left, right):
+                self.expr(left)
+                self.expr(right)
+                self.emit(_BINARY[type(e)])
+            case Neg(expr):
+                self.expr(expr)
+                self.emit(NEG)
+            case Not(expr):
+                self.expr(expr)
+                self.emit(NOT)
+            case And(left, right) | Or(left, right):
+                self.expr(left)
+                jump = self.emit(AND if isinstance(e, And) else OR)
+                self.expr(right)
+                self.emit(CHECK_BOOL, 0 if isinstance(e, And) else 1)
+                self.patch(jump)
+            case If(cond, then_branch, else_branch) | Ifnz(cond, then_branch, else_branch):
+                self.expr(cond)
+                if isinstance(e, If):
+                    to_else = self.emit(BRANCH_FALSE)
+                else:
+                    # Ifnz takes its then branch on a nonzero condition
+                    to_else = self.emit(BRANCH_ZERO)
+                self.expr(then_branch, tail)
+                to_end = self.emit(JUMP)
+                self.patch(to_else)
+                self.expr(else_branch, tail)
+                self.patch(to_end)
+            case Let(name, expr, body):
+                self.expr(expr)
+                self.emit(BIND, self.const(name))
+                self.expr(body, tail)
+                self.emit(UNBIND)
+            case Letfun(name, param, bodyexpr, inexpr):
+                self.emit(MAKE_CLOSURE, self.const(compile_function(e, self.fusions, self.tiers)))
+                self.expr(inexpr, tail)
+                self.emit(UNBIND)
+            case App(fun, arg):
+                self.expr(fun)
+                self.emit(PUSH_ROOT)
+                self.expr(arg)
+                self.emit(TAIL_CALL if tail else CALL)
+            case Assign(name, expr):
+                target = self.const((name, e.depth))
+                self.emit(CHECK_ASSIGN, target)
+                self.expr(expr)
+                self.emit(STORE, target)
+            case Seq():
+                # Walk the spine iteratively: generated scripts chain thousands of statements
+                *init, last = seqSpine(e)
+                for stmt in init:
+                    self.expr(stmt)
+                    self.emit(POP)
+                self.expr(last, tail)
+            case Show(expr):
+                self.expr(expr)
+                self.emit(SHOW)
+            case Read():
+                self.emit(READ)
+            case Command(command):
+                self.emit(COMMAND, self.const(tuple(command.split())))
+            case Redirect(command, stream, target):
+                operand = self.const((stream, target))
+                self.emit(CHECK_STREAM, operand)
+                self.expr(command)
+                self.emit(REDIRECT, operand)
+            case ShellAnd(left, right) | ShellOr(left, right):
+                kind = 0 if isinstance(e, ShellAnd) else 1
+                self.expr(left)
+                self.emit(SHELL_LEFT, kind)
+                self.expr(right)
+                self.emit(SHELL_RIGHT, kind)
+            case _:
+                self.emit(CONST, self.const(None))  # Anything else evaluates to None, as in interp_fun
+
+
+def compile_function(e: Letfun, fusions: frozenset[str] | None = ALL_SUPERINSTRUCTIONS,
+                     tiers: Tiers | None = None) -> Function:
+    '''Compile the body of a resolved Letfun to a Function'''
+    compiler = _Compiler(e.name, fusions, tiers)
+    compiler.expr(e.bodyexpr, True)
+    compiler.emit(RETURN)
+    return Function(e.name, e.param, e.bodyexpr, compiler.chunk(), e.pure, tiers)
+
+
+def compile_expr(e: Expr, scope: tuple[str, ...] = (),
+                 fusions: frozenset[str] | None = ALL_SUPERINSTRUCTIONS, tiers: Tiers | None = None) -> Chunk:
+    '''Optimize e for an environment binding the names in scope (see
+    interp_fun.optimizeExpr, which reports unbound names) and compile it to a Chunk.
+    The peephole pass uses the superinstructions named in fusions; None skips the
+    pass altogether, leaving the code exactly as compiled.  With tiers, the
+    letfun bodies in e move to compiled code when hot (see Tiers).'''
+    compiler = _Compiler('<main>', fusions, tiers)
+    compiler.expr(optimizeExpr(e, scope))
+    compiler.emit(RETURN)
+    return compiler.chunk()
+
+
+def select_superinstructions(profile: Counter, min_share: float = 0.01) -> frozenset[str]:
+    '''The superinstructions whose sequences start with an instruction pair making
+    up at least min_share of the pairs dispatched in profile (see run_chunk)'''
+    total = sum(profile.values()) or 1
+    return frozenset(name for name, sequences in SUPERINSTRUCTIONS.items()
+                     if sum(profile[sequence[:2]] for sequence in sequences) / total >= min_share)
+
+
+# -- Runtime helpers -- #
+
+def _read():
+    s = input("Enter an integer: ")
+    try:
+        return int(s.strip().strip("'\""))
+    except Exception:
+        raise EvalError("Input was not an integer")
+
+def _command(parts, env, store):
+    processed_parts = []
+    for part in parts:
+        if part.startswith('$'):
+            var_name = part[1:]
+            loc = lookupEnv(var_name, env)
+            if loc is None:
+                raise EvalError(f"Undefined variable: {var_name}")
+            processed_parts.append(str(store.get(loc)))
+        else:
+            processed_parts.append(part)
+    if not processed_parts:
+        raise EvalError("Empty command")
+    return {'type': 'command', 'executable': processed_parts[0], 'args': processed_parts[1:], 'redirects': {}}
+
+def _pipe(l, r):
+    if l['type'] != 'command':
+        raise ValueError("Left side of pipe must be a command")
+    if r['type'] != 'command':
+        raise ValueError("Right side of pipe must be a command")
+    return {**l, 'pipes': [*l.get('pipes', []), r]}
+
+def _integer_op(op, message):
+    def apply(l, r):
+        if not (isinstance(l, int) and isinstance(r, int)):
+            raise TypeError(message)
+        return op(l, r)
+    return apply
+
+def _eq(l, r):
+    return type(l) == type(r) and l == r
+
+_BINARY_OPS = {
+    ADD: addValues,
+    SUB: _integer_op(lambda l, r: l - r, "Sub expects integers"),
+    MUL: _integer_op(lambda l, r: l * r, "Mul expects integers"),
+    DIV: divValues,
+    LT: _integer_op(lambda l, r: l < r, "Lt expects integers"),
+    GT: _integer_op(lambda l, r: l > r, "Gt expects integers"),
+    EQ: _eq,
+    PIPE: _pipe,
+}
+
+# The same operators on two plain ints, which need no checks (DIV still does)
+_INT_OPS = {ADD: operator.add, SUB: operator.sub, MUL: operator.mul, LT: operator.lt, GT: operator.gt, EQ: operator.eq}
+
+_SHELL = (('shell_and', '&&'), ('shell_or', '||'))
+
+
+# -- VM -- #
+
+def run_chunk(chunk: Chunk, env, store: Store, profile: Counter | None = None):
+    '''Run chunk in env and store.  env must be the last of store.roots, which is
+    where a caller (evalInEnv, or an App calling a Function) puts it.  If profile
+    is given, count each pair of consecutively dispatched opcodes in it.'''
+    code, consts = chunk.code, chunk.consts
+    stack: list = []
+    push, pop = stack.append, stack.pop
+    roots = store.roots
+    # Saved (code, consts, ip, env, base, memo) of each caller.  base is the index in
+    # roots of the current call's environment, memo the (table, key) to remember its result under.
+    frames: list[tuple] = []
+    base, memo = len(roots) - 1, None
+    ip = 0
+    previous = RETURN
+    while True:
+        op = code[ip]
+        arg = code[ip + 1]
+        ip += 2
+        if profile is not None:
+            profile[previous, op] += 1
+            previous = op
+        if op == LOAD:
+            if arg == 0:
+                push(store.get(env[1]))
+            else:
+                push(store.get(envLoc(env, arg)))
+        elif op == CONST:
+            push(consts[arg])
+        elif op == LOAD_OP_CONST:
+            depth, binary, r = consts[arg]
+            l = store.get(env[1] if depth == 0 else envLoc(env, depth))
+            # Plain ints, the common case, skip the checked helpers
+            push(_INT_OPS[binary](l, r) if type(l) is int and type(r) is int and binary in _INT_OPS
+                 else _BINARY_OPS[binary](l, r))
+        elif POP <= op <= PIPE:
+            if op == POP:
+                pop()
+                continue
+            r = pop()
+            l = stack[-1]
+            stack[-1] = (_INT_OPS[op](l, r) if type(l) is int and type(r) is int and op in _INT_OPS
+                         else _BINARY_OPS[op](l, r))
+        elif BRANCH_NOT_LT <= op <= BRANCH_NOT_EQ:
+            r = pop()
+            l = pop()
+            compare = op - BRANCH_NOT_LT + LT
+            if not (_INT_OPS[compare](l, r) if type(l) is int and type(r) is int else _BINARY_OPS[compare](l, r)):
+                ip = arg
+        elif op == LOAD_CALLEE:
+            fun = store.get(env[1] if arg == 0 else envLoc(env, arg))
+            push(fun)
+            roots.append(fun)
+        elif op == BINARY_CONST:
+            binary, r = consts[arg]
+            l = stack[-1]
+            stack[-1] = (_INT_OPS[binary](l, r) if type(l) is int and type(r) is int and binary in _INT_OPS
+                         else _BINARY_OPS[binary](l, r))
+        elif op == BRANCH_FALSE:
+            test = pop()
+            if not isinstance(test, bool):
+                raise TypeError("If condition must be a boolean")
+            if not test:
+                ip = arg
+        elif op == CALL or op == TAIL_CALL:
+            a = pop()
+            fun = pop()
+            if not isinstance(fun, Closure):
+                raise EvalError("application of non-function")
+            key = memoKey(a) if fun.memo is not None else None
+            if key is not None:
+                result = memoRecall(fun.memo, key, store)
+                if result is not None:
+                    roots.pop()
+                    push(result)
+                    continue
+            fun_code = fun.code
+            if fun_code is None:
+                body = resolve(fun.body, (fun.param, *envNames(fun.env)))
+                fun_code = fun.code = compile_function(Letfun('<closure>', fun.param, body, Lit(0)))
+            new_env = extendEnv(fun.param, store.alloc(a), fun.env)
+            roots[-1] = new_env
+            if type(fun_code) is Function:
+                if op == CALL:
+                    fun_code.calls += 1
+                else:
+                    fun_code.loops += 1
+                tiers = fun_code.tiers
+                result = None
+                if tiers is not None and tiers.nesting < tiers.max_nesting and (
+                        fun_code.compiled is not None or fun_code.calls + fun_code.loops >= tiers.threshold):
+                    result = tiers.run(fun_code, new_env, store)
+            else:
+                result = fun_code(new_env, store)  # Compiled by interp_fun or codegen
+            if result is not None:
+                # Run in a compiled tier: finish its tail calls here
+                while type(result) is TailCall:
+                    roots[-1] = result.env
+                    result = result.code(result.env, store)
+                roots.pop()
+                if key is not None:
+                    memoRemember(fun.memo, key, result, store)
+                push(result)
+                continue
+            if op == CALL:
+                frames.append((code, consts, ip, env, base, memo))
+                base, memo = len(roots) - 1, (fun.memo, key) if key is not None else None
+            else:
+                # Replace the current call, dropping its scopes; its result will be the callee's
+                del roots[base:-1]
+            code, consts, ip, env = fun_code.chunk.code, fun_code.chunk.consts, 0, new_env
+        elif op == RETURN:
+            result = pop()
+            if memo is not None:
+                memoRemember(memo[0], memo[1], result, store)
+            if not frames:
+                del roots[base + 1:]  # The scopes a peephole-removed UNBIND would have left
+                return result
+            del roots[base:]
+            code, consts, ip, env, base, memo = frames.pop()
+            push(result)
+        elif op == PUSH_ROOT:
+            roots.append(stack[-1])  # Keep the closure's environment alive while the argument runs
+        elif op == BIND:
+            env = extendEnv(consts[arg], store.alloc(pop()), env)
+            roots.append(env)
+        elif op == UNBIND:
+            env = env[2]
+            roots.pop()
+        elif op == JUMP:
+            ip = arg
+        elif op == AND or op == OR:
+            v = stack[-1]
+            if not isinstance(v, bool):
+                raise TypeError("And expects booleans" if op == AND else "Or expects booleans")
+            # And evaluates the right operand only when v is true, Or only when it is false
+            if v == (op == OR):
+                ip = arg
+            else:
+                pop()
+        elif op == CHECK_BOOL:
+            if not isinstance(stack[-1], bool):
+                raise TypeError("Or expects booleans" if arg else "And expects booleans")
+        elif op == BRANCH_ZERO:
+            test = pop()
+            if not isinstance(test, int):
+                raise TypeError("Ifnz condition must be an integer")
+            if test == 0:
+                ip = arg
+        elif op == NEG:
+            v = stack[-1]
+            if not isinstance(v, int):
+                raise TypeError("Negative expects an integer")
+            stack[-1] = -v
+        elif op == NOT:
+            v = stack[-1]
+            if not isinstance(v, bool):
+                raise TypeError("Not expects booleans")
+            stack[-1] = not v
+        elif op == MAKE_CLOSURE:
+            function = consts[arg]
+            c = Closure(function.param, function.body, env, function, newMemo(store) if function.pure else None)
+            env = extendEnv(function.name, store.alloc(c), env)
+            c.env = env
+            roots.append(env)
+        elif op == CHECK_ASSIGN:
+            name, depth = consts[arg]
+            if isinstance(store.get(envLoc(env, depth)), Closure):
+                raise EvalError(f"Cannot assign to function: {name}")
+        elif op == STORE:
+            store.set(envLoc(env, consts[arg][1]), stack[-1])
+        elif op == SHOW:
+            print(stack[-1])
+        elif op == READ:
+            push(_read())
+        elif op == COMMAND:
+            push(_command(consts[arg], env, store))
+        elif op == CHECK_STREAM:
+            if consts[arg][0] not in ['stdin', 'stdout', 'stderr']:
+                raise ValueError(f"Invalid stream: {consts[arg][0]}")
+        elif op == REDIRECT:
+            stream, target = consts[arg]
+            v = stack[-1]
+            stack[-1] = {**v, 'redirects': [v.get('redirects', []), {stream: target}]}
+        elif op == SHELL_LEFT or op == SHELL_RIGHT:
+            executable, symbol = _SHELL[arg]
+            v = stack[-1]
+            if not isinstance(v, dict) or v.get('type') != 'command':
+                side = 'Left' if op == SHELL_LEFT else 'Right'
+                raise ValueError(f"{side} side of shell {symbol} must be a command")
+            if op == SHELL_RIGHT:
+                r = pop()
+                stack[-1] = {'type': 'command', 'executable': executable,
+                             'left_cmd': stack[-1], 'right_cmd': r, 'operator': symbol}
+
+
+def evalInEnv(env, store: Store, e: Expr, tiers: Tiers | None = None):
+    '''Compile e for env and run it on the VM, with tiered execution if tiers is given'''
+    roots = store.roots
+    depth = len(roots)
+    chunk = compile_expr(e, envNames(env), tiers=tiers)
+    roots.append(env)
+    try:
+        return run_chunk(chunk, env, store)
+    finally:
+        del roots[depth:]  # Also drops whatever an exception left behind
+
+
+def eval(e: Expr, env=None, store=None, tiers: Tiers | None = None):
+    return evalInEnv(emptyEnv if env is None else env, Store() if store is None else store, e, tiers)
+
+
+# -- Disassembler -- #
+
+def disassemble(chunk: Chunk) -> str:
+    '''A listing of chunk and of the functions in its constant pool, one instruction per line'''
+    lines, pending, seen = [], [chunk], set()
+    while pending:
+        chunk = pending.pop(0)
+        if id(chunk) in seen:
+            continue
+        seen.add(id(chunk))
+        lines.append(f'{chunk.name}:')
+        code = chunk.code
+        for offset in range(0, len(code), 2):
+            op, arg = code[offset], code[offset + 1]
+            name = OPCODES[op]
+            if op in _JUMPS:
+                operand = f'-> {arg}'
+            elif op in (CONST, BIND, COMMAND, CHECK_STREAM, REDIRECT, CHECK_ASSIGN, STORE, MAKE_CLOSURE):
+                value = chunk.consts[arg]
+                operand = f'{arg} ({value!r})'
+                if isinstance(value, Function):
+                    pending.append(value.chunk)
+            elif op == LOAD_OP_CONST:
+                depth, binary, value = chunk.consts[arg]
+                operand = f'{arg} ({depth} {OPCODES[binary]} {value!r})'
+            elif op == BINARY_CONST:
+                binary, value = chunk.consts[arg]
+                operand = f'{arg} ({OPCODES[binary]} {value!r})'
+            elif op in (LOAD, LOAD_CALLEE, CHECK_BOOL, SHELL_LEFT, SHELL_RIGHT):
+                operand = str(arg)
+            else:
+                operand = ''
+            lines.append(f'{offset:6}  {name:<13} {operand}'.rstrip())
+    return '\n'.join(lines)